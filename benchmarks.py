@@ -0,0 +1,192 @@
+"""
+timings of the coronacaster stages on synthetic data - no network needed
+
+    python benchmarks.py --output bench.json
+    python benchmarks.py --baseline bench.json
+
+With a baseline, every stage slower than the baseline by more than the tolerance is
+reported as a regression and the exit code is 1.
+"""
+
+
+def synthetic_data(countries=20, days=120, seed=0):
+
+    """
+    logistic cumulative case curves of made-up countries in the layout of get_data_from_eu()
+
+    :param countries: number of countries
+    :param days: number of days per country
+    :param seed: random seed
+    :return: dataframe with "dates", "countries", "cases" and "deaths" columns
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.RandomState(seed)
+    dates = pd.date_range('2020-01-01', periods=days)
+    t = np.arange(days)
+
+    frames = []
+    for ci in range(countries):
+        peak = 10 ** rng.uniform(3, 5)
+        cumulative = peak / (1 + np.exp(-rng.uniform(0.08, 0.2) * (t - rng.uniform(0.3, 0.6) * days)))
+        cases = np.maximum(np.diff(np.r_[0, cumulative]) + rng.normal(0, np.sqrt(peak) / 10, days), 0).round()
+        frames.append(pd.DataFrame({'dates': dates, 'countries': 'Country%02d' % ci,
+                                    'cases': cases, 'deaths': (cases * 0.02).round()}))
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def timed(function, repeat=1):
+
+    """
+    best wall time of a function over repeats
+
+    :param function: function without arguments
+    :param repeat: number of runs
+    :return: seconds
+    """
+
+    import time
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def run(ftypes=('poly1', 'poly3', 'exp', 'logistic'), draws=1000, quick=False):
+
+    """
+    time the stages
+
+    :param ftypes: model types to build and sample
+    :param draws: number of draws per sampling run
+    :param quick: smaller data and fewer repeats
+    :return: dict of stage name: seconds
+    """
+
+    import os
+    import tempfile
+    import numpy as np
+    import pandas as pd
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import pymc3 as pm
+
+    import coronacaster
+    from coronacaster import models
+    from coronacaster.forecast import _window
+    from coronacaster.sampling import sample_mcmc
+    from coronacaster.utils import calculateStats, modelfit_eval_dates, poly_fun
+
+    repeat = 1 if quick else 3
+    data = synthetic_data(countries=5 if quick else 50)
+
+    timings = {}
+    timings['index'] = timed(lambda: coronacaster.CountrySeriesIndex(data), repeat)
+    index = coronacaster.CountrySeriesIndex(data)
+
+    country = index.countries[0]
+    timings['window'] = timed(lambda: _window(country, data), repeat)
+    timings['window_world'] = timed(lambda: _window('World', data), repeat)
+    _, window, _, _, x, y = _window(country, index)
+
+    # the first model build of a process also sets up theano - not counted
+    models.cached_model(ftypes[0], x, y, **coronacaster.forecast(country, index, ftype=ftypes[0], return_inis=True))
+
+    for ftype in ftypes:
+        priors = coronacaster.forecast(country, index, ftype=ftype, return_inis=True)
+        models._model_cache.clear()
+
+        timings['build_%s' % ftype] = timed(lambda: models.cached_model(ftype, x, y, **priors))
+        model, varnames, modelfun = models.cached_model(ftype, x, y, **priors)
+        timings['compile_%s' % ftype] = timed(lambda: models.cached_step(ftype, pm.Slice))
+
+        step = models.cached_step(ftype, pm.Slice)
+        seconds = timed(lambda: sample_mcmc(model, step, varnames + ['sigma'], samples=draws, tune=0, chains=1,
+                                            cores=1))
+        timings['sample_1k_%s' % ftype] = seconds * 1000 / draws
+
+    trace = np.random.RandomState(0).normal(size=200000)
+    timings['calculateStats'] = timed(lambda: calculateStats(trace), repeat)
+
+    varstats = [[1, 0.1, 0.9, 1.1], [40, 4, 36, 44], [0.3, 0.03, 0.27, 0.33]]
+
+    def evaluate():
+        modelfit_eval_dates(y, x, pd.DatetimeIndex(window['dates']), poly_fun, varstats, varnames=['a0', 'a1', 'a2'],
+                            target=len(x) + 14, sigma=10, plotstrs=['', '', ''])
+        plt.close('all')
+
+    timings['modelfit_eval_dates'] = timed(evaluate, repeat)
+
+    def plot():
+        coronacaster.plot_country(country, index)
+        plt.close('all')
+
+    timings['plot_country'] = timed(plot, repeat)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'countries.pdf')
+        timings['plot_countries'] = timed(lambda: coronacaster.plot_countries(index.countries, index, path), repeat)
+
+    return timings
+
+
+def compare(timings, baseline, tolerance=0.2, noise=0.005):
+
+    """
+    stages slower than the baseline
+
+    :param timings: dict of stage name: seconds
+    :param baseline: dict of stage name: seconds of an earlier run
+    :param tolerance: allowed relative slowdown
+    :param noise: slowdowns of fewer seconds than this are not counted
+    :return: dict of stage name: ratio to the baseline, for the regressed stages
+    """
+
+    return {name: seconds / baseline[name] for name, seconds in timings.items()
+            if name in baseline and seconds > baseline[name] * (1 + tolerance) and seconds - baseline[name] > noise}
+
+
+def main():
+
+    import sys
+    import json
+    import time
+    import argparse
+    import platform
+
+    parser = argparse.ArgumentParser(description='time the coronacaster stages on synthetic data')
+    parser.add_argument('--output', help='write the timings to this json file')
+    parser.add_argument('--baseline', help='json file of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown')
+    parser.add_argument('--ftypes', default='poly1,poly3,exp,logistic', help='comma separated model types')
+    parser.add_argument('--quick', action='store_true', help='smaller data and fewer repeats')
+    args = parser.parse_args()
+
+    timings = run(ftypes=args.ftypes.split(','), quick=args.quick)
+    for name, seconds in timings.items():
+        print('%-24s %10.4f s' % (name, seconds))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'time': time.time(), 'timings': timings}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['timings']
+        regressions = compare(timings, baseline, args.tolerance)
+        for name, ratio in regressions.items():
+            print('REGRESSION %s: %.2fx the baseline' % (name, ratio))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
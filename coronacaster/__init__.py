@@ -1,5 +1,10 @@
-from .data import get_data_from_eu
-from .plots import plot_country
+from .data import get_data_from_eu, update_data
+from .plots import plot_country, plot_countries
 from .forecast import forecast
+from .series import CountrySeriesIndex
+from .batch import forecast_many, forecast_pooled
+from .backtest import backtest, leaderboard
+from .profiling import Profile
+from .service import serve, ServiceClient
 
-del data, plots
\ No newline at end of file
+del data, plots, series, batch, profiling, service
\ No newline at end of file
@@ -0,0 +1,146 @@
+def backtest(countries, data, ftypes=('poly1', 'poly2', 'exp', 'logistic'), cutoffs=None, horizon=7,
+             workers=None, cpu_cores=4, samples=2000, tune=1000, chains=4, sampler='nuts',
+             quantiles=(0.1, 0.9), **kwargs):
+
+    """
+    rolling-origin backtest of model types
+
+    Every model type is fitted to the data of every country up to each cutoff date and its
+    prediction horizon days later is compared to the cumulative cases that were then reported.
+    The fits run in a process pool as in forecast_many(), and each worker reuses the compiled
+    models between the cutoffs.
+
+        scores = coronacaster.backtest(['Finland', 'Sweden'], index)
+        coronacaster.leaderboard(scores)
+
+    :param countries: list of country names
+    :param data: dataframe as in forecast() or a CountrySeriesIndex
+    :param ftypes: model types as in forecast()
+    :param cutoffs: last dates of data in the fits - defaults to rolling_cutoffs(data, horizon)
+    :param horizon: days from the cutoff to the predicted date
+    :param workers: number of fits at the same time, see run_forecasts()
+    :param cpu_cores: total number of cores to use
+    :param samples: number of samples per chain
+    :param tune: number of tuning steps per chain
+    :param chains: number of chains per fit
+    :param sampler: 'slice' or 'nuts' as in forecast()
+    :param quantiles: quantiles of the prediction - the outermost two give the coverage
+    :param **kwargs: other forecast() parameters, e.g. method='map' and laplace=True for a quick run
+    :return: dataframe with one row per country, model type and cutoff
+    """
+
+    import datetime
+    import numpy as np
+    import pandas as pd
+
+    from .batch import run_forecasts, _check_params
+    from .series import CountrySeriesIndex
+
+    _check_params(kwargs)
+    if not isinstance(data, CountrySeriesIndex):
+        data = CountrySeriesIndex(data)
+
+    if cutoffs is None:
+        cutoffs = rolling_cutoffs(data, horizon)
+    cutoffs = [pd.Timestamp(cutoff).date() for cutoff in cutoffs]
+
+    params = dict(kwargs, samples=samples, tune=tune, chains=chains, sampler=sampler, quantiles=quantiles,
+                  plot=False)
+    tasks = [((country, ftype, cutoff), dict(params, country=country, ftype=ftype, enddate=cutoff,
+                                             targetdate=cutoff + datetime.timedelta(days=horizon)))
+             for country in countries for ftype in ftypes for cutoff in cutoffs]
+
+    low, high = '%g%%' % (min(quantiles) * 100), '%g%%' % (max(quantiles) * 100)
+
+    rows = []
+    for (country, ftype, cutoff), df, error in run_forecasts(tasks, data, cpu_cores=cpu_cores, workers=workers):
+        target = cutoff + datetime.timedelta(days=horizon)
+        row = {'country': country, 'ftype': ftype, 'cutoff': cutoff, 'target': target,
+               'actual': realized(data, country, target), 'error': error}
+        if df is not None:
+            result = df.iloc[:, 0]
+            name = 'prediction' if 'prediction' in result.index else 'target_fit'
+            row.update(prediction=result[name], low=result.get(name + '_' + low, np.nan),
+                       high=result.get(name + '_' + high, np.nan))
+        rows.append(row)
+
+    scores = pd.DataFrame(rows, columns=['country', 'ftype', 'cutoff', 'target', 'prediction', 'low', 'high',
+                                         'actual', 'error'])
+    scores['abs_error'] = (scores.prediction - scores.actual).abs()
+    scores['pct_error'] = 100 * scores.abs_error / scores.actual.where(scores.actual > 0)
+    covered = (scores.low <= scores.actual) & (scores.actual <= scores.high)
+    scores['covered'] = covered.where(scores.low.notna() & scores.actual.notna())
+
+    return scores.sort_values(['country', 'ftype', 'cutoff']).reset_index(drop=True)
+
+
+def leaderboard(scores, by='country'):
+
+    """
+    model types ranked by their backtest errors
+
+    :param scores: output of backtest()
+    :param by: column to rank the model types within, e.g. 'country' - None for one ranking over all
+    :return: dataframe of mean absolute and percentage errors, coverage of the prediction interval,
+             number of scored and failed fits and the rank (1 is the best mean percentage error)
+    """
+
+    groups = ['ftype'] if by is None else [by, 'ftype']
+
+    scored = scores.assign(failed=scores.prediction.isna())
+    board = scored.groupby(groups).agg(mae=('abs_error', 'mean'),
+                                       mape=('pct_error', 'mean'),
+                                       coverage=('covered', 'mean'),
+                                       fits=('abs_error', 'count'),
+                                       failed=('failed', 'sum'))
+
+    if by is None:
+        board['rank'] = board.mape.rank(method='min')
+        return board.sort_values('rank')
+
+    board['rank'] = board.groupby(level=0).mape.rank(method='min')
+    return board.sort_values([by, 'rank'])
+
+
+def rolling_cutoffs(data, horizon=7, count=4, step=7):
+
+    """
+    cutoff dates at the end of the data that leave horizon days to score
+
+    :param data: CountrySeriesIndex
+    :param horizon: days from the cutoff to the predicted date
+    :param count: number of cutoffs
+    :param step: days between the cutoffs
+    :return: list of dates, the latest last
+    """
+
+    import datetime
+    import pandas as pd
+
+    last = pd.Timestamp(data.get('World')['dates'].max()).date()
+
+    return [last - datetime.timedelta(days=horizon + step * k) for k in reversed(range(count))]
+
+
+def realized(data, country, date):
+
+    """
+    cumulative cases of a country at a date, as reported in the data
+
+    :param data: CountrySeriesIndex
+    :param country: country name
+    :param date: date
+    :return: cumulative cases, NaN if the data doesn't reach the date
+    """
+
+    import numpy as np
+
+    if country not in data:
+        return np.nan
+
+    series = data.get(country)
+    position = np.searchsorted(series['dates'], np.datetime64(date, 'ns'), side='right') - 1
+    if position < 0 or series['dates'][position] != np.datetime64(date, 'ns'):
+        return np.nan
+
+    return series['cumcases'][position]
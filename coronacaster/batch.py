@@ -0,0 +1,245 @@
+# forecast() parameters the batch functions cannot pass - with them forecast() returns no result frame
+RESERVED_PARAMS = {'profile', 'profile_hook', 'return_inis'}
+
+
+def forecast_many(countries, data, ftype='poly1', workers=None, cpu_cores=4, chains=20, plot=False, **kwargs):
+
+    """
+    forecast several countries in a process pool and combine the results
+
+    The cpu_cores are shared between the countries fitted at the same time and
+    the chains of each fit, so that workers * cores per fit never exceeds cpu_cores.
+    A fit that raises is recorded in the "error" column and the batch continues.
+
+    :param countries: list of country names
+    :param data: dataframe as in forecast() or a CountrySeriesIndex
+    :param ftype: model type as in forecast()
+    :param workers: number of countries fitted at the same time - defaults to as many as cpu_cores allows
+    :param cpu_cores: total number of cores to use
+    :param chains: number of chains per fit
+    :param plot: plot each fit - only useful with workers=1, the figures of the pool processes are discarded
+    :param **kwargs: other forecast() parameters, e.g. samples, tune, targetdate or model priors
+    :return: dataframe with one row of forecast() results per country and an "error" column
+    """
+
+    import pandas as pd
+
+    _check_params(kwargs)
+    tasks = [(country, dict(kwargs, country=country, ftype=ftype, chains=chains, plot=plot)) for country in countries]
+
+    rows = {}
+    errors = {}
+    for country, df, error in run_forecasts(tasks, data, cpu_cores=cpu_cores, workers=workers):
+        rows[country] = df.iloc[:, 0] if df is not None else pd.Series(dtype=float)
+        errors[country] = error
+
+    result = pd.DataFrame.from_dict(rows, orient='index').reindex(list(countries))
+    result.index.name = 'country'
+    result['error'] = pd.Series(errors)
+
+    return result
+
+
+def forecast_pooled(countries, data, ftype='logistic', samples=2000, startdate=None, enddate=None, limit=0,
+                    targetdate=None, tune=1000, chains=4, cpu_cores=4, method='mcmc', laplace=False,
+                    iterations=50000, sampler='nuts', target_rhat=None, target_ess=None, chunk=1000,
+                    plot=False, quantiles=(0.1, 0.9), band_draws=4000, **kwargs):
+
+    """
+    forecast several countries with one hierarchical model, see models.hierarchical_model()
+
+    All countries are fitted in one sampler run of one compiled model. The cumulative cases of
+    each country are divided by their maximum in the fit, and the results are scaled back.
+
+    :param countries: list of country names
+    :param data: dataframe as in forecast() or a CountrySeriesIndex
+    :param ftype: 'logistic' or 'exp'
+    :param startdate: start date of the data of every country, defaults to where its cumulative count exceeds limit
+    :param enddate: end date of the data of every country, defaults to its last date with cases
+    :param **kwargs: hyperpriors of hierarchical_model(), e.g. expo=[mu, sigma]; the other parameters are as in forecast()
+    :return: dataframe with one row of forecast() results per country
+    """
+
+    import datetime
+    import numpy as np
+    import pandas as pd
+    import pymc3 as pm
+
+    from .forecast import _window, _default_priors, _evaluate
+    from .models import hierarchical_model, model_key
+    from .sampling import sample_mcmc, fit_advi, fit_map, map_point, map_functions, gradient_function
+    from .series import CountrySeriesIndex
+    from .utils import plot_modelfit
+
+    key = model_key(ftype)
+    if key is None or key[0] not in ('exp', 'logistic'):
+        raise ValueError("ftype must be 'exp' or 'logistic', not %r" % ftype)
+    ftype = key[0]
+
+    if not isinstance(data, CountrySeriesIndex):
+        data = CountrySeriesIndex(data)
+
+    windows = []
+    for country in countries:
+        series, window, start, end, x, y = _window(country, data, startdate, enddate, limit)
+        priors = {}
+        log = _default_priors(ftype, x, y, series, priors)
+        windows.append((window, start, end, np.asarray(x, dtype=float), y, priors, max(y.max(), 1)))
+
+    group = np.concatenate([np.full(len(w[3]), ci) for ci, w in enumerate(windows)])
+    x = np.concatenate([w[3] for w in windows])
+    y = np.concatenate([w[4] / w[6] for w in windows])
+
+    # priors of each country in the scaled units, as arrays of shape (2, countries)
+    scaled = {'intercept': True, 'slope': True, 'shifted': False}
+    priors = {name: np.transpose([np.divide(w[5][name], w[6] if scale else 1) for w in windows])
+              for name, scale in scaled.items() if name in windows[0][5]}
+
+    model, varnames, modelfun = hierarchical_model(ftype, group, x, y, **dict(priors, **kwargs))
+    names = varnames + ['sigma']
+
+    if method == 'map':
+        functions = map_functions(model)
+        trace = fit_map(model, functions, gradient=gradient_function(model) if laplace else None, draws=samples)
+    elif 'advi' in method:
+        trace = fit_advi(model, names, method=method, draws=samples, iterations=iterations,
+                         start=map_point(model, map_functions(model)))
+    else:
+        # smaller steps than usual - the countries pin their own parameters much tighter than the hyperpriors
+        step = pm.NUTS(model=model, target_accept=0.95) if sampler == 'nuts' else pm.Slice(model=model)
+        trace = sample_mcmc(model, step, names, samples=samples, tune=tune, chains=chains, cores=cpu_cores,
+                            target_rhat=target_rhat, target_ess=target_ess, chunk=chunk)
+
+    rows = {}
+    for ci, (country, (window, start, end, xc, yc, _, scale)) in enumerate(zip(countries, windows)):
+        posterior = {name: trace[name][..., ci] * (scale if name in ('intercept', 'slope', 'peak', 'sigma') else 1)
+                     for name in names}
+        xTarget = None if targetdate is None else (targetdate - start).days
+        df, fit, sigma = _evaluate(posterior, varnames, modelfun, xc, yc, xTarget, quantiles, band_draws)
+        rows[country] = df.iloc[:, 0]
+
+        if plot:
+            plotstrs = ['%s COVID-19 cases hierarchical %s model' % (country, ftype),
+                        '%s to %s' % (datetime.datetime.strftime(start, '%d.%m.%Y'),
+                                      datetime.datetime.strftime(end, '%d.%m.%Y')),
+                        'cumulative cases']
+            plot_modelfit(yc, pd.DatetimeIndex(window['dates']), fit, varnames=varnames, sigma=sigma, plotstrs=plotstrs, log=log)
+
+    result = pd.DataFrame.from_dict(rows, orient='index')
+    result.index.name = 'country'
+
+    return result
+
+
+def run_forecasts(tasks, data, cpu_cores=4, workers=None):
+
+    """
+    run forecast() for a list of tasks in a process pool
+
+    :param tasks: list of (key, forecast kwargs) pairs - the kwargs must contain "country"
+    :param data: dataframe as in forecast() or a CountrySeriesIndex
+    :param cpu_cores: total number of cores to use
+    :param workers: number of fits at the same time - defaults to min(len(tasks), cpu_cores)
+    :return: generator of (key, result dataframe or None, error message or None) in completion order
+    """
+
+    import concurrent.futures
+    from .series import CountrySeriesIndex
+
+    if not isinstance(data, CountrySeriesIndex):
+        data = CountrySeriesIndex(data)
+
+    if len(tasks) == 0:
+        return
+
+    workers, cores_per_fit = budget_cores(len(tasks), cpu_cores, workers)
+
+    if workers == 1:
+        _init_worker(data, headless=False)
+        for key, params in tasks:
+            yield (key,) + _run_task(params, cores_per_fit)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=_init_worker,
+                                                initargs=(data,)) as pool:
+        futures = {pool.submit(_run_task, params, cores_per_fit): key for key, params in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                df, error = future.result()
+            except Exception as e:
+                # the worker process itself died, e.g. out of memory
+                df, error = None, '%s: %s' % (type(e).__name__, e)
+            yield futures[future], df, error
+
+
+def budget_cores(tasks, cpu_cores, workers=None):
+
+    """
+    split cpu_cores between concurrent fits and the chains within a fit
+
+    :param tasks: number of fits to run
+    :param cpu_cores: total number of cores to use
+    :param workers: requested number of concurrent fits
+    :return: number of concurrent fits, cores per fit
+    """
+
+    cpu_cores = max(1, cpu_cores)
+    if workers is None:
+        workers = min(tasks, cpu_cores)
+    workers = max(1, min(workers, tasks, cpu_cores))
+
+    return workers, max(1, cpu_cores // workers)
+
+
+_worker_data = None
+_worker_headless = False
+
+
+def _check_params(kwargs):
+
+    reserved = set(kwargs) & RESERVED_PARAMS
+    if reserved:
+        raise ValueError('%s cannot be used in a batch of forecasts' % ', '.join(sorted(reserved)))
+
+
+def _init_worker(data, headless=True):
+
+    import os
+
+    global _worker_data, _worker_headless
+    _worker_data = data
+    _worker_headless = headless
+
+    if headless:
+        # the pool workers have no display
+        os.environ.setdefault('MPLBACKEND', 'Agg')
+
+
+def _run_task(params, cores_per_fit):
+
+    from .forecast import forecast
+
+    params = dict(params, cpu_cores=cores_per_fit)
+
+    try:
+        df = forecast(data=_worker_data, **params)
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, e)
+    finally:
+        # the figures of a pool process are never shown - in the caller's process they are the user's
+        if _worker_headless:
+            _close_figures()
+
+    if df is None:
+        return None, 'unknown ftype %r' % params.get('ftype')
+
+    return df, None
+
+
+def _close_figures():
+
+    import sys
+
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
@@ -0,0 +1,150 @@
+# bump when the stored results change meaning - older entries then never match
+RESULT_VERSION = 1
+
+# total size of the stored results before the least recently used are removed
+MAX_BYTES = 256 * 2 ** 20
+
+
+def result_key(ftype, x, y, priors, settings):
+
+    """
+    key of a fit result - a hash of the fitted data, the model and the fit settings
+
+    :param ftype: model type as in forecast()
+    :param x: datapoints of the fit window
+    :param y: data of the fit window
+    :param priors: model priors as passed to the model
+    :param settings: other parameters that change the result, e.g. dates, samples and sampler
+    :return: hex digest
+    """
+
+    import json
+    import hashlib
+    import numpy as np
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps([RESULT_VERSION, ftype, priors, settings], sort_keys=True, default=_jsonable).encode())
+    digest.update(np.ascontiguousarray(x, dtype=float).tobytes())
+    digest.update(np.ascontiguousarray(y, dtype=float).tobytes())
+
+    return digest.hexdigest()
+
+
+def load_result(key, cache_dir=None):
+
+    """
+    stored fit result of a key
+
+    :param key: output of result_key()
+    :param cache_dir: cache directory as in data.get_cache_dir()
+    :return: (result dataframe, posterior dict or None), or None if nothing is stored
+    """
+
+    import os
+    import numpy as np
+    import pandas as pd
+
+    directory = _result_dir(cache_dir)
+    path = os.path.join(directory, key + '.pkl')
+    if not os.path.exists(path):
+        return None
+
+    df = pd.read_pickle(path)
+    os.utime(path)  # used now - keep it over older entries
+
+    posterior = None
+    trace_path = os.path.join(directory, key + '.npz')
+    if os.path.exists(trace_path):
+        with np.load(trace_path) as stored:
+            posterior = {name: stored[name] for name in stored.files}
+        os.utime(trace_path)
+
+    return df, posterior
+
+
+def store_result(key, df, posterior=None, cache_dir=None, max_bytes=MAX_BYTES):
+
+    """
+    store a fit result and evict the least recently used results above max_bytes
+
+    :param key: output of result_key()
+    :param df: result dataframe of forecast()
+    :param posterior: dict of variable name: array of draws to store compressed with the result
+    :param cache_dir: cache directory as in data.get_cache_dir()
+    :param max_bytes: maximum total size of the stored results
+    """
+
+    import os
+    import numpy as np
+
+    directory = _result_dir(cache_dir)
+    path = os.path.join(directory, key)
+
+    if posterior is not None:
+        # np.savez adds the suffix to names without one
+        np.savez_compressed(path + '.tmp.npz', **posterior)
+        os.replace(path + '.tmp.npz', path + '.npz')
+
+    # the dataframe is written last - a result counts as stored only when it exists
+    df.to_pickle(path + '.tmp.pkl')
+    os.replace(path + '.tmp.pkl', path + '.pkl')
+
+    evict(max_bytes, cache_dir)
+
+
+def evict(max_bytes=MAX_BYTES, cache_dir=None):
+
+    """
+    remove the least recently used results until their total size is at most max_bytes
+
+    :param max_bytes: maximum total size of the stored results
+    :param cache_dir: cache directory as in data.get_cache_dir()
+    """
+
+    import os
+
+    directory = _result_dir(cache_dir)
+
+    entries = {}
+    for name in os.listdir(directory):
+        key, suffix = os.path.splitext(name)
+        if suffix not in ('.pkl', '.npz') or key.endswith('.tmp'):
+            continue
+        stat = os.stat(os.path.join(directory, name))
+        used, size = entries.get(key, (0, 0))
+        entries[key] = (max(used, stat.st_mtime), size + stat.st_size)
+
+    total = sum(size for used, size in entries.values())
+    for key, (used, size) in sorted(entries.items(), key=lambda entry: entry[1][0]):
+        if total <= max_bytes:
+            break
+        for suffix in ('.pkl', '.npz'):
+            path = os.path.join(directory, key + suffix)
+            if os.path.exists(path):
+                os.remove(path)
+        total -= size
+
+
+def _result_dir(cache_dir):
+
+    import os
+    from .data import get_cache_dir
+
+    directory = os.path.join(get_cache_dir(cache_dir), 'results')
+    os.makedirs(directory, exist_ok=True)
+
+    return directory
+
+
+def _jsonable(value):
+
+    import numpy as np
+
+    if hasattr(value, 'to_dict'):
+        return {str(k): v for k, v in value.to_dict().items()}
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return str(value)
@@ -0,0 +1,307 @@
+MANIFEST_DEFAULTS = {'ftypes': ['poly1'],
+                     'windows': [{}],
+                     'targetdates': [None],
+                     'params': {},
+                     'data': {},
+                     'cpu_cores': 4,
+                     'workers': None}
+
+WINDOW_KEYS = ('startdate', 'enddate', 'limit')
+
+# set by the manifest itself or by the runner
+RESERVED_PARAMS = {'country', 'data', 'ftype', 'targetdate', 'plot', 'profile', 'profile_hook',
+                   'cpu_cores'} | set(WINDOW_KEYS)
+
+
+def main(argv=None):
+
+    """
+    the coronacaster command
+
+        coronacaster run manifest.json results.parquet
+        coronacaster serve --port 8150 --workers 2
+
+    A killed run is resumed by running the same command again: every finished fit is
+    stored in the checkpoint directory and only the missing fits are run.
+
+    :param argv: command line arguments without the program name, defaults to sys.argv[1:]
+    :return: exit code - 1 if a fit of the run failed
+    """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='coronacaster',
+                                     description='forecast runs from job manifests and the forecast service')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='forecast every country, model type, window and target date of a manifest')
+    run.add_argument('manifest', help='job manifest .json, see load_manifest()')
+    run.add_argument('output', help='consolidated results, .parquet or .csv')
+    run.add_argument('--checkpoints', help='directory of the finished fits, defaults to the output name + ".parts"')
+    run.add_argument('--cpu-cores', type=int, help='total number of cores, overrides the manifest')
+    run.add_argument('--workers', type=int, help='number of fits at the same time, overrides the manifest')
+    run.add_argument('--retry-failed', action='store_true', help='run the failed fits of an earlier run again')
+    run.add_argument('--offline', action='store_true', help='use the stored data snapshot without network')
+
+    serve = commands.add_parser('serve', help='run the forecast service, see service.serve()')
+    serve.add_argument('--source', help='data file or url, defaults to the ECDC data')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8150)
+    serve.add_argument('--workers', type=int, default=2)
+    serve.add_argument('--cpu-cores', type=int, default=4)
+    serve.add_argument('--warm', default='poly1', help='comma separated model types compiled when a worker starts')
+    serve.add_argument('--cache-dir', help='directory of the result cache')
+    serve.add_argument('--offline', action='store_true', help='use the stored data snapshot without network')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        from .data import get_data_from_eu, SOURCE
+        from .service import serve as serve_forecasts
+
+        data = get_data_from_eu(args.source or SOURCE, offline=args.offline)
+        serve_forecasts(data, host=args.host, port=args.port, workers=args.workers, cpu_cores=args.cpu_cores,
+                        warm=[ftype for ftype in args.warm.split(',') if ftype], cache_dir=args.cache_dir)
+        return 0
+
+    manifest = load_manifest(args.manifest)
+    if args.offline:
+        manifest['data'] = dict(manifest['data'], offline=True)
+    for name in ('cpu_cores', 'workers'):
+        if getattr(args, name) is not None:
+            manifest[name] = getattr(args, name)
+
+    results = run_manifest(manifest, args.output, checkpoints=args.checkpoints, retry_failed=args.retry_failed)
+
+    return 1 if results.error.notna().any() else 0
+
+
+def load_manifest(path):
+
+    """
+    read and check a job manifest
+
+    The manifest is a json object - every country is fitted with every model type, window
+    and target date:
+
+        {"countries": ["Finland", "Sweden"],
+         "ftypes": ["poly1", "poly2"],
+         "windows": [{"startdate": "2020-03-15", "enddate": "2020-04-15"}, {"limit": 100}],
+         "targetdates": ["2020-04-30", null],
+         "params": {"samples": 2000, "chains": 4, "method": "mcmc"},
+         "data": {"source": "COVID-19-geographic-disbtribution-worldwide.xlsx"},
+         "cpu_cores": 8}
+
+    Only "countries" is required. A window has any of "startdate", "enddate" and "limit", a null
+    target date fits without a prediction, "params" are other forecast() parameters (including
+    model priors) and "data" are get_data_from_eu() parameters.
+
+    :param path: path of the .json file
+    :return: manifest dict with the defaults filled in
+    """
+
+    import json
+
+    with open(path) as f:
+        manifest = json.load(f)
+
+    if not isinstance(manifest, dict):
+        raise ValueError('%s: the manifest must be a json object' % path)
+
+    unknown = set(manifest) - set(MANIFEST_DEFAULTS) - {'countries'}
+    if unknown:
+        raise ValueError('%s: unknown manifest keys %s' % (path, ', '.join(sorted(unknown))))
+    if not manifest.get('countries'):
+        raise ValueError('%s: the manifest has no countries' % path)
+
+    manifest = dict(MANIFEST_DEFAULTS, **manifest)
+
+    for window in manifest['windows']:
+        if not isinstance(window, dict) or set(window) - set(WINDOW_KEYS):
+            raise ValueError('%s: a window is an object of %s, not %r' % (path, ', '.join(WINDOW_KEYS), window))
+
+    reserved = set(manifest['params']) & RESERVED_PARAMS
+    if reserved:
+        raise ValueError('%s: %s cannot be set in the params' % (path, ', '.join(sorted(reserved))))
+
+    if isinstance(manifest['data'], str):
+        manifest['data'] = {'source': manifest['data']}
+
+    return manifest
+
+
+def run_manifest(manifest, output, checkpoints=None, retry_failed=False, data=None, log=None):
+
+    """
+    run the fits of a manifest, resuming from the checkpoints of an earlier run
+
+    Each finished fit (or its error) is written to its own file in the checkpoint directory as
+    soon as it arrives, named by a hash of its parameters and of the data of its window. Fits
+    with a checkpoint are not run again, so a killed run continues where it stopped, while a
+    rerun on updated data fits again the windows whose data changed. When all fits are done
+    their rows are written to the output.
+
+    :param manifest: manifest dict as returned by load_manifest()
+    :param output: path of the consolidated results, .parquet or .csv
+    :param checkpoints: checkpoint directory, defaults to the output path + ".parts"
+    :param retry_failed: run the fits whose checkpoint is an error again
+    :param data: dataframe or CountrySeriesIndex to use instead of manifest["data"]
+    :param log: function called with a progress message per finished fit, defaults to printing to stderr
+    :return: dataframe of the results, one row per fit with an "error" column
+    """
+
+    import os
+    import sys
+    import time
+    import pandas as pd
+
+    from .batch import run_forecasts
+    from .series import CountrySeriesIndex
+
+    if not output.lower().endswith(('.parquet', '.csv')):
+        raise ValueError('output must be a .parquet or .csv file, not %r' % output)
+
+    if log is None:
+        def log(message):
+            print(message, file=sys.stderr, flush=True)
+
+    if checkpoints is None:
+        checkpoints = output + '.parts'
+    os.makedirs(checkpoints, exist_ok=True)
+
+    if data is None:
+        from .data import get_data_from_eu
+        data = get_data_from_eu(**manifest['data'])
+    if not isinstance(data, CountrySeriesIndex):
+        data = CountrySeriesIndex(data)
+
+    tasks = manifest_tasks(manifest, data)
+    rows = {}
+    todo = []
+    for name, params in tasks:
+        row = _read_checkpoint(checkpoints, name)
+        if row is None or (retry_failed and row.get('error') is not None):
+            todo.append((name, params))
+        else:
+            rows[name] = row
+
+    log('%d fits, %d done earlier, %d to run' % (len(tasks), len(rows), len(todo)))
+
+    if todo:
+        labels = dict(tasks)
+        started = time.time()
+        for done, (name, df, error) in enumerate(run_forecasts(todo, data, cpu_cores=manifest['cpu_cores'],
+                                                                workers=manifest['workers']), 1):
+            row = _task_row(labels[name])
+            if df is not None:
+                row.update(df.iloc[:, 0].items())
+            row['error'] = error
+            _write_checkpoint(checkpoints, name, row)
+            rows[name] = row
+
+            log('[%d/%d] %s %s %s after %.0f s' % (done, len(todo), row['country'], row['ftype'],
+                                                   'failed: ' + error if error else 'done', time.time() - started))
+
+    results = pd.DataFrame([rows[name] for name, _ in tasks])
+    error = results.pop('error')
+    results['error'] = error.astype(object).where(error.notna(), None)
+    _write_results(results, output)
+
+    return results
+
+
+def manifest_tasks(manifest, data):
+
+    """
+    the fits of a manifest
+
+    The checkpoint name of a fit is a hash of its forecast() parameters and of the dates and
+    cumulative cases of its window, so it changes when the data of the window is updated.
+
+    :param manifest: manifest dict as returned by load_manifest()
+    :param data: dataframe or CountrySeriesIndex the fits are made with
+    :return: list of (checkpoint name, forecast kwargs) pairs, in the order of the manifest
+    """
+
+    import json
+    import hashlib
+    import pandas as pd
+
+    tasks = []
+    for country in manifest['countries']:
+        for ftype in manifest['ftypes']:
+            for window in manifest['windows']:
+                for targetdate in manifest['targetdates']:
+                    params = dict(manifest['params'], country=country, ftype=ftype, plot=False,
+                                  targetdate=targetdate, **window)
+                    for name in ('startdate', 'enddate', 'targetdate'):
+                        if params.get(name) is not None:
+                            params[name] = pd.Timestamp(params[name]).date()
+                    if 'quantiles' in params:
+                        params['quantiles'] = tuple(params['quantiles'])
+
+                    digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode())
+                    digest.update(_window_data(data, params))
+                    tasks.append((digest.hexdigest()[:20], params))
+
+    return tasks
+
+
+def _window_data(data, params):
+
+    from .forecast import _window
+
+    try:
+        _, window, _, _, _, cumcases = _window(params['country'], data, params.get('startdate'),
+                                               params.get('enddate'), params.get('limit', 0))
+    except (KeyError, ValueError) as e:
+        # the fit fails the same way until the data changes
+        return repr(e).encode()
+
+    return window['dates'].astype('datetime64[D]').tobytes() + cumcases.astype(float).tobytes()
+
+
+def _task_row(params):
+
+    row = {'country': params['country'], 'ftype': params['ftype'], 'limit': params.get('limit')}
+    for name in ('startdate', 'enddate', 'targetdate'):
+        value = params.get(name)
+        row[name] = None if value is None else str(value)
+
+    return row
+
+
+def _read_checkpoint(directory, name):
+
+    import os
+    import json
+
+    try:
+        with open(os.path.join(directory, name + '.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_checkpoint(directory, name, row):
+
+    import os
+    import json
+
+    path = os.path.join(directory, name + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump({key: value.item() if hasattr(value, 'item') else value for key, value in row.items()}, f)
+    # a fit counts as done only when its file is complete
+    os.replace(path + '.tmp', path)
+
+
+def _write_results(results, output):
+
+    import os
+
+    temporary = output + '.tmp'
+    if output.lower().endswith('.parquet'):
+        results.to_parquet(temporary, index=False)
+    else:
+        results.to_csv(temporary, index=False)
+    os.replace(temporary, output)
@@ -1,15 +1,329 @@
-def get_data_from_eu():
+SOURCE = 'https://www.ecdc.europa.eu/sites/default/files/documents/COVID-19-geographic-disbtribution-worldwide.xlsx'
+
+# bump when the layout of the stored snapshot changes - older snapshots are then ignored
+SNAPSHOT_VERSION = 1
+
+COLUMNS = ['dates', 'countries', 'cases', 'deaths']
+
+
+def get_data_from_eu(source=SOURCE, cache=True, cache_dir=None, ttl=24 * 3600, offline=False, refresh=False):
+
+    """
+    load the ECDC worldwide data as a normalized dataframe
+
+    The normalized frame (dates, countries, cases, deaths) is stored as a versioned
+    Arrow snapshot together with the content hash of the source, so later loads are
+    memory-mapped reads instead of a download and an xlsx parse.
+
+    :param source: url or local file path (xlsx, csv, parquet or arrow) of the data
+    :param cache: store and reuse snapshots of the normalized data
+    :param cache_dir: directory for the snapshots - defaults to $CORONACASTER_CACHE or ~/.cache/coronacaster
+    :param ttl: seconds after which a snapshot of an url source is downloaded again
+    :param offline: never touch the network - use the latest snapshot of the url regardless of its age
+    :param refresh: ignore the ttl and reload the source
+    :return: dataframe with "dates", "countries", "cases" and "deaths" columns
+    """
+
+    import os
+    import time
+
+    local = os.path.exists(source)
+
+    if not cache:
+        if offline and not local:
+            raise FileNotFoundError('offline mode needs a local source or cache=True')
+        return _normalize(_read_source(source, _fetch(source)))
+
+    cache_dir = get_cache_dir(cache_dir)
+    manifest = _read_manifest(cache_dir, source)
+
+    if manifest is not None and not local and not refresh:
+        fresh = time.time() - manifest['fetched'] < ttl
+        if fresh or offline:
+            return _read_snapshot(cache_dir, manifest)
+
+    if offline and not local:
+        raise FileNotFoundError('no snapshot of %s in %s to use offline' % (source, cache_dir))
+
+    raw = _fetch(source)
+    digest = _content_hash(raw)
+
+    if manifest is not None and manifest['hash'] == digest:
+        # same content as before - the snapshot is still valid, only its age changes
+        manifest['fetched'] = time.time()
+        _write_manifest(cache_dir, source, manifest)
+        return _read_snapshot(cache_dir, manifest)
+
+    data = _normalize(_read_source(source, raw))
+    _write_snapshot(cache_dir, source, data, digest)
+
+    return data
+
+
+def update_data(updates, source=SOURCE, cache_dir=None, index=None):
+
+    """
+    apply daily update files to the stored snapshot of a source
+
+    The rows of the updates are validated and deduplicated by (country, date) - a later row
+    replaces an earlier one - and compared to the snapshot. New rows are appended and changed
+    rows replaced, and the snapshot is stored again. Update files already applied to the
+    snapshot are skipped, so a directory of daily files can be applied again every day.
+    When a later download finds the source changed, its new snapshot replaces the updates.
+
+        data, changed = coronacaster.update_data('updates/', index=index)
+        coronacaster.forecast_many(changed, index)
+
+    :param updates: csv or json file, url or directory of such files (applied in name order), dataframe,
+                    or a list of these
+    :param source: source of the snapshot as in get_data_from_eu() - it must have been loaded before
+    :param cache_dir: directory of the snapshots as in get_data_from_eu()
+    :param index: CountrySeriesIndex to update in place with the same changes
+    :return: updated dataframe as from get_data_from_eu(), sorted list of the changed countries
+    """
+
+    import pandas as pd
+
+    cache_dir = get_cache_dir(cache_dir)
+    manifest = _read_manifest(cache_dir, source)
+    if manifest is None:
+        raise FileNotFoundError('no snapshot of %s in %s to update - load it with get_data_from_eu() first'
+                                % (source, cache_dir))
+
+    data = _read_snapshot(cache_dir, manifest)
+    applied = manifest.get('updates', [])
+
+    frames = []
+    for name, raw in _update_files(updates):
+        digest = _content_hash(raw) if raw is not None else None
+        if digest in applied:
+            continue
+        frame = name if raw is None else _read_source(name, raw)
+        frames.append(_validate(_normalize(frame), 'dataframe' if raw is None else name))
+        if digest is not None:
+            applied = applied + [digest]
+
+    if not frames:
+        return data, []
+
+    rows = pd.concat(frames, ignore_index=True).drop_duplicates(['countries', 'dates'], keep='last')
+
+    # the rows that are new or differ from the snapshot
+    key = ['countries', 'dates']
+    merged = rows.merge(data, on=key, how='left', suffixes=('', '_old'), indicator=True)
+    differs = (merged._merge == 'left_only') | (merged.cases != merged.cases_old) | (merged.deaths != merged.deaths_old)
+    changes = merged.loc[differs.values, COLUMNS]
+
+    if len(changes) > 0:
+        replaced = data.set_index(key).index.isin(changes.set_index(key).index)
+        data = pd.concat([data[~replaced], changes.astype(data.dtypes.to_dict())], ignore_index=True)
+
+    _write_snapshot(cache_dir, source, data, manifest['hash'], updates=applied, fetched=manifest['fetched'])
+
+    if index is not None:
+        index.update(changes)
+
+    return data, sorted(changes.countries.unique())
+
+
+def get_cache_dir(cache_dir=None):
+
+    """
+    directory where coronacaster keeps its on-disk caches
+
+    :param cache_dir: explicit directory, else $CORONACASTER_CACHE or ~/.cache/coronacaster
+    :return: path of the (created) directory
+    """
+
+    import os
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('CORONACASTER_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'coronacaster'))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+
+def _fetch(source):
+
+    import os
+    import urllib.request
+
+    if os.path.exists(source):
+        with open(source, 'rb') as f:
+            return f.read()
+
+    with urllib.request.urlopen(source) as response:
+        return response.read()
+
+
+def _update_files(updates):
+
+    import os
+
+    if not isinstance(updates, (list, tuple)):
+        updates = [updates]
+
+    for update in updates:
+        if not isinstance(update, str):
+            yield update, None
+        elif os.path.isdir(update):
+            for name in sorted(os.listdir(update)):
+                if name.lower().endswith(('.csv', '.json')):
+                    path = os.path.join(update, name)
+                    yield path, _fetch(path)
+        else:
+            yield update, _fetch(update)
+
+
+def _validate(data, name):
 
     import pandas as pd
 
-    source = 'https://www.ecdc.europa.eu/sites/default/files/documents/COVID-19-geographic-disbtribution-worldwide.xlsx'
+    data['cases'] = pd.to_numeric(data.cases, errors='coerce')
+    data['deaths'] = pd.to_numeric(data.deaths, errors='coerce')
+
+    invalid = data.dates.isna() | data.cases.isna() | data.deaths.isna() | data.countries.isin(['', 'nan'])
+    if invalid.any():
+        raise ValueError('%d invalid rows in %s, e.g.\n%s' % (invalid.sum(), name, data[invalid].head()))
+
+    data['dates'] = data.dates.dt.normalize()
+
+    return data
+
+
+def _content_hash(raw):
+
+    import hashlib
+
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _read_source(source, raw):
+
+    import io
+    import json
+    import pandas as pd
+
+    buffer = io.BytesIO(raw)
+    name = source.lower().split('?')[0]
+
+    if name.endswith('.csv'):
+        return pd.read_csv(buffer)
+    if name.endswith('.json'):
+        # ECDC publishes {"records": [...]}
+        records = json.loads(raw)
+        return pd.DataFrame(records['records'] if isinstance(records, dict) else records)
+    if name.endswith('.parquet'):
+        return pd.read_parquet(buffer)
+    if name.endswith('.arrow') or name.endswith('.feather'):
+        return pd.read_feather(buffer)
+
+    return pd.read_excel(buffer)
+
+
+def _normalize(data):
+
+    import pandas as pd
+
+    if not set(COLUMNS).issubset(data.columns):
+        # raw ECDC layout: dateRep, day, month, year, cases, deaths, countriesAndTerritories, ...
+        cols = data.columns.tolist()
+        cols[0] = 'dates'
+        cols[6] = 'countries'
+        # a new frame - the caller's, e.g. one passed to update_data(), is not changed
+        data = data.set_axis(cols, axis=1)
+        if not pd.api.types.is_datetime64_any_dtype(data.dates):
+            # dateRep is dd/mm/yyyy
+            data['dates'] = pd.to_datetime(data.dates, dayfirst=True)
+
+    data = data[COLUMNS].copy()
+    if not pd.api.types.is_datetime64_any_dtype(data.dates):
+        # update files and other sources have ISO dates, yyyy-mm-dd
+        data['dates'] = pd.to_datetime(data.dates)
+    data['countries'] = data.countries.astype(str)
+
+    return data.reset_index(drop=True)
+
+
+def _manifest_path(cache_dir, source):
+
+    import os
+    import hashlib
+
+    key = hashlib.sha1(source.encode()).hexdigest()[:12]
+
+    return os.path.join(cache_dir, 'snapshot_%s.json' % key)
+
+
+def _read_manifest(cache_dir, source):
+
+    import os
+    import json
+
+    path = _manifest_path(cache_dir, source)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        manifest = json.load(f)
+
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        return None
+    if not os.path.exists(os.path.join(cache_dir, manifest['file'])):
+        return None
+
+    return manifest
+
+
+def _write_manifest(cache_dir, source, manifest):
+
+    import os
+    import json
+
+    path = _manifest_path(cache_dir, source)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def _write_snapshot(cache_dir, source, data, digest, updates=(), fetched=None):
+
+    import os
+    import time
+    import pyarrow as pa
+
+    # the applied updates make a different snapshot of the same source content
+    filename = 'snapshot_v%d_%s.arrow' % (SNAPSHOT_VERSION, _content_hash(' '.join([digest] + list(updates)).encode())[:16]
+                                          if updates else digest[:16])
+    path = os.path.join(cache_dir, filename)
+
+    # uncompressed Arrow IPC file so that reads can be memory-mapped without copies
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    with pa.OSFile(path + '.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(path + '.tmp', path)
+
+    previous = _read_manifest(cache_dir, source)
+    if previous is not None and previous['file'] != filename:
+        os.remove(os.path.join(cache_dir, previous['file']))
+
+    _write_manifest(cache_dir, source, {'version': SNAPSHOT_VERSION,
+                                        'source': source,
+                                        'hash': digest,
+                                        'fetched': time.time() if fetched is None else fetched,
+                                        'file': filename,
+                                        'rows': len(data),
+                                        'updates': list(updates)})
+
+
+def _read_snapshot(cache_dir, manifest):
 
-    data = pd.read_excel(source)
-    
-    cols = data.columns.tolist()
-    cols[0] = 'dates'
-    cols[6] = 'countries'
+    import os
+    import pyarrow as pa
 
-    data.columns = cols
-    
-    return data
\ No newline at end of file
+    path = os.path.join(cache_dir, manifest['file'])
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
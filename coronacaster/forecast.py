@@ -10,6 +10,26 @@ def forecast(country,
              chains=20,
              cpu_cores=4,
              return_inis=False,
+             method='mcmc',
+             laplace=False,
+             iterations=50000,
+             sampler='slice',
+             target_rhat=None,
+             target_ess=None,
+             chunk=1000,
+             thin=1,
+             trace_dtype=None,
+             trace_dir=None,
+             previous=None,
+             warm_tune=None,
+             cache=False,
+             cache_trace=False,
+             cache_dir=None,
+             plot=True,
+             quantiles=(0.1, 0.9),
+             band_draws=4000,
+             profile=False,
+             profile_hook=None,
              **kwargs):
     
     """
@@ -17,6 +37,7 @@ def forecast(country,
 
     :param country:  Country name, if there is "countries" column in the data - else use "World or "" for all data
     :param data: dataframe with "dates" (datetime) and "cases" columns - coses is the number of daily new cases
+                 or a CountrySeriesIndex built from it
     :param ftype:  'polyN' where N is a number between 0 and a few (don't try more than 10 or so - becomes quite slow)
                 or  'exp'  for exponential
     :param samples: number of samples to use
@@ -27,55 +48,249 @@ def forecast(country,
         import datetime
         targetdate = datetime.datetime.strptime('2020-06-30','%Y-%m-%d').date()
     :param return_inis: don't run but return initial parameters
+    :param method: 'mcmc' for Slice sampling, 'advi' or 'fullrank_advi' for a variational fit,
+                'map' for the maximum a posteriori point only, or 'analytic' for the polyN models: the
+                posterior in closed form by conjugate linear regression (see sampling.conjugate_posterior()),
+                with samples independent draws from it
+    :param laplace: with method='map', draw samples from a Laplace approximation around the point for uncertainty
+    :param iterations: with method='advi' or 'fullrank_advi', maximum number of optimization steps
+    :param sampler: with method='mcmc', 'slice' or 'nuts'
+    :param target_rhat: with method='mcmc', draw in chunks and stop when R-hat of all parameters is at most this
+    :param target_ess: with method='mcmc', draw in chunks and stop when the effective sample size is at least this
+    :param chunk: number of samples per chain between the convergence checks of target_rhat and target_ess,
+                and drawn at a time with thin, trace_dtype or trace_dir
+    :param thin: with method='mcmc', keep every thin-th sample
+    :param trace_dtype: with method='mcmc', dtype of the kept samples, e.g. 'float32' for half the memory
+    :param trace_dir: with method='mcmc', write the kept samples to a temporary directory under this directory
+                instead of keeping them in memory - the statistics are then computed one variable at a time
+    :param previous: result of an earlier forecast() of the same country and ftype, e.g. from the day before,
+                or dict of parameter name: [mean, std] - the fit starts from this posterior
+    :param warm_tune: number of tuning steps when starting from previous, defaults to tune // 5
+    :param cache: return the stored result of an identical earlier call (same data window, model, priors and
+                settings) instead of fitting again, and store new results - see cache.py. With 'only' nothing is
+                fitted: the stored result is returned, or None
+    :param cache_trace: also store the posterior draws, so that cached results are plotted again
+    :param cache_dir: directory of the result cache, defaults to the data cache directory
+    :param plot: plot the fit and the forecast - with False no figure is made, e.g. in batch jobs
+    :param quantiles: quantiles of the posterior predictive at the target, the outermost two are plotted as a band
+    :param band_draws: number of posterior draws used for the quantiles, evenly thinned from the trace
+    :param profile: also return the profiling.Profile of the stages - wall and CPU time, peak memory and draws per second
+    :param profile_hook: function called with the dict of every stage when it ends, see profiling.Profile
     :param **kwargs: model params if wanted to use like intercept=[int_mean,int_std]
-    :return: fitresults
+    :return: fitresults, or (fitresults, profile) with profile=True
     """
     
-    import pymc3 as pm
+    import os
+    import shutil
     import datetime
     import pandas as pd
 
-    from .utils import calculateStats, modelfit_eval_dates
-    from .models import poly_model, exp_model, logistic_model
-    
-    if isinstance(startdate, str):
-        startdate = pd.to_datetime(startdate)
-
-    if country=="World" or country=="all" or len(country)==0:
-        temp = data.sort_values('dates')
-        temp['cases'] = temp.groupby(['dates'])['cases'].transform('sum')
-        temp['deaths'] = temp.groupby(['dates'])['deaths'].transform('sum')
-        temp.drop_duplicates(subset=['dates'], inplace=True)
-    
-    else:
-        temp = data[data.countries == country].sort_values('dates')
+    from .utils import plot_modelfit
+    from .models import cached_model, cached_step, cached_function, model_key, model_functions, _model_cache
+    from .sampling import summary_from_result, warm_start, sample_mcmc, fit_advi, fit_map, fit_analytic, map_point, \
+        map_functions, gradient_function
+    from .cache import result_key, load_result, store_result
+    from .profiling import Profile, draw_counts
 
-    temp['cumcases']=temp.cases.cumsum().values
-    if startdate == None:
-        startdate = temp[temp.cumcases > limit].dates.dt.date.min()
+    if method not in ('mcmc', 'advi', 'fullrank_advi', 'map', 'analytic'):
+        raise ValueError("method must be 'mcmc', 'advi', 'fullrank_advi', 'map' or 'analytic', not %r" % method)
 
-    if enddate == None:
-        enddate = temp[temp.cases > 0].dates.dt.date.max()
-    
-    temp_new = temp[(temp.dates.dt.date>=startdate) & (temp.dates.dt.date<=enddate)]
-    intercept = next((value for key, value in kwargs.items() if key == 'intercept'), None)
-    if intercept is None:
-        intercept = temp_new.cumcases.values.min()
-        kwargs['intercept'] = [intercept, intercept / 10 + 20]
+    if sampler not in ('slice', 'nuts'):
+        raise ValueError("sampler must be 'slice' or 'nuts', not %r" % sampler)
 
-    try:
-        x0 = temp_new.dates.dt.date - startdate
-    except:
-        x0 = temp_new.dates - startdate
+    stages = Profile(profile_hook, country=country, ftype=ftype, method=method)
+
+    def result(df):
+        return (df, stages) if profile else df
 
-    x = x0.dt.days
-    y = temp_new.cumcases.values
+    with stages.stage('window'):
+        series, window, startdate, enddate, x, y = _window(country, data, startdate, enddate, limit)
 
     if targetdate == None:
         xTarget = None
     else:
         xTarget = (targetdate - startdate).days
 
+    with stages.stage('priors'):
+        log = _default_priors(ftype, x, y, series, kwargs)
+    if log is None:
+        return result(None)
+
+    if method == 'analytic' and model_key(ftype)[0] != 'poly':
+        raise ValueError("method='analytic' is only for the polyN models, not %r" % ftype)
+
+    if return_inis:
+        return kwargs
+
+    key = None
+    cached = None
+    if cache:
+        with stages.stage('cache_load') as stage:
+            key = result_key(ftype, x, y, kwargs,
+                             dict(startdate=startdate, enddate=enddate, targetdate=targetdate, samples=samples,
+                                  tune=tune, chains=chains, method=method, laplace=laplace, iterations=iterations,
+                                  sampler=sampler, target_rhat=target_rhat, target_ess=target_ess, chunk=chunk,
+                                  thin=thin, trace_dtype=trace_dtype, previous=previous, warm_tune=warm_tune,
+                                  quantiles=quantiles, band_draws=band_draws))
+            cached = load_result(key, cache_dir)
+            stage['hit'] = cached is not None
+        if cached is not None and (cached[1] is None or cache == 'only'):
+            return result(cached[0])
+        if cache == 'only':
+            return result(None)
+
+    start = None
+    store_dir = None
+    try:
+        if cached is not None:
+            # stored with its posterior - only the statistics and the plot are redone, no model is built
+            varnames, modelfun = model_functions(ftype)
+            trace = cached[1]
+
+        elif method == 'analytic':
+            # closed form - no model is built or compiled
+            varnames, modelfun = model_functions(ftype)
+            with stages.stage('fit') as stage:
+                trace = fit_analytic(x, y, model_key(ftype)[1], draws=samples, random_seed=0, **kwargs)
+                stage.update(draw_counts(trace))
+
+        else:
+            with stages.stage('build') as stage:
+                stage['reused'] = model_key(ftype) in _model_cache
+                model, varnames, modelfun = cached_model(ftype, x, y, **kwargs)
+
+            if previous is not None:
+                start = warm_start(model, summary_from_result(previous, varnames + ['sigma']), chains)
+                tune = tune // 5 if warm_tune is None else warm_tune
+
+            if method == 'map':
+                with stages.stage('compile'):
+                    functions = cached_function(ftype, 'map', map_functions)
+                    gradient = cached_function(ftype, 'gradient', gradient_function) if laplace else None
+                with stages.stage('fit') as stage:
+                    trace = fit_map(model, functions, gradient=gradient, draws=samples)
+                    stage.update(draw_counts(trace))
+
+            elif 'advi' in method:
+                with stages.stage('compile'):
+                    functions = cached_function(ftype, 'map', map_functions)
+                with stages.stage('fit') as stage:
+                    start = map_point(model, functions)
+                    trace = fit_advi(model, varnames + ['sigma'], method=method, draws=samples, iterations=iterations,
+                                     start=start)
+                    stage.update(draw_counts(trace))
+
+            else:
+                import tempfile
+                import pymc3 as pm
+
+                with stages.stage('compile'):
+                    step = cached_step(ftype, {'slice': pm.Slice, 'nuts': pm.NUTS}[sampler])
+                # pymc3 tunes and draws in one run - the tuning is in the wall time but not in the draws
+                if trace_dir is not None:
+                    os.makedirs(trace_dir, exist_ok=True)
+                    store_dir = tempfile.mkdtemp(prefix='trace-', dir=trace_dir)
+                with stages.stage('sample', sampler=sampler) as stage:
+                    # the draws made, not the ones kept after thinning
+                    counts = {}
+                    trace = sample_mcmc(model, step, varnames + ['sigma'], samples=samples, tune=tune, chains=chains,
+                                        cores=cpu_cores, target_rhat=target_rhat, target_ess=target_ess, chunk=chunk,
+                                        start=start, thin=thin, dtype=trace_dtype, trace_dir=store_dir, counts=counts)
+                    stage.update(counts, tune=tune)
+
+        with stages.stage('evaluate'):
+            df, fit, sigma = _evaluate(trace, varnames, modelfun, x, y, xTarget, quantiles, band_draws,
+                                       stats_chunk=1 if store_dir is not None else None)
+
+        if plot:
+            with stages.stage('plot'):
+                plotstrs = ['%s COVID-19 cases %s model'%(country, ftype),
+                            '%s to %s'%(datetime.datetime.strftime(startdate, '%d.%m.%Y'),
+                                        datetime.datetime.strftime(enddate, '%d.%m.%Y')),
+                            'cumulative cases']
+                plot_modelfit(y, pd.DatetimeIndex(window['dates']), fit, varnames=varnames, sigma=sigma, plotstrs=plotstrs, log=log)
+
+        if cache and cached is None:
+            with stages.stage('cache_store'):
+                store_result(key, df, trace if cache_trace else None, cache_dir)
+
+        return result(df)
+
+    finally:
+        # also when the fit or the evaluation fails, or the run is interrupted
+        if store_dir is not None:
+            trace = None
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+
+def _window(country, data, startdate=None, enddate=None, limit=0):
+
+    """
+    cumulative cases of a country between the start and end dates
+
+    The dates are converted to days once, and the window is found with binary searches
+    on them - no dataframe is copied or filtered.
+
+    :param country: country name as in forecast()
+    :param data: dataframe or CountrySeriesIndex as in forecast()
+    :param startdate: start date, defaults to where the cumulative count exceeds limit
+    :param enddate: end date, defaults to the last date with cases
+    :param limit: take start date to be where cumulative count exceeds limit
+    :return: all data of the country and the data of the window as dicts of arrays (see series.country_arrays(),
+             with "x" for the days from the start date), start date, end date,
+             days from the start date and cumulative cases of the window
+    """
+
+    import numpy as np
+    import pandas as pd
+    from .series import country_arrays, first_over
+
+    series = dict(country_arrays(country, data))
+    days = series['dates'].astype('datetime64[D]')
+
+    if startdate is None:
+        first = first_over(series['cumcases'], limit)
+        if first == len(days):
+            raise ValueError('no cumulative cases over %g for %r' % (limit, country))
+        startdate = days[first].item()
+    else:
+        startdate = pd.Timestamp(startdate).date()
+
+    if enddate is None:
+        enddate = days[np.flatnonzero(series['cases'] > 0)[-1]].item()
+    else:
+        enddate = pd.Timestamp(enddate).date()
+
+    start = np.datetime64(startdate, 'D')
+    series['x'] = (days - start).astype(int)
+
+    part = slice(np.searchsorted(days, start, side='left'),
+                 np.searchsorted(days, np.datetime64(enddate, 'D'), side='right'))
+    window = {name: values[part] for name, values in series.items()}
+
+    return series, window, startdate, enddate, window['x'], window['cumcases']
+
+
+def _default_priors(ftype, x, y, series, kwargs):
+
+    """
+    fill in the priors not given in kwargs from the data
+
+    :param ftype: model type as in forecast()
+    :param x: days of the window
+    :param y: cumulative cases of the window
+    :param series: all data of the country, as from _window()
+    :param kwargs: model priors - updated in place
+    :return: y scale of the plot, 'lin' or 'log' - None for unknown types
+    """
+
+    import numpy as np
+
+    intercept = next((value for key, value in kwargs.items() if key == 'intercept'), None)
+    if intercept is None:
+        intercept = y.min()
+        kwargs['intercept'] = [intercept, intercept / 10 + 20]
+
     log = 'lin'
     
     if ftype=='exp':
@@ -83,20 +298,13 @@ def forecast(country,
         if slope is None:
             a10 = (y.max() - y[0]) / x.max()
             kwargs['slope'] = [a10 / 2, a10 / 4 + 10]
-        if return_inis:
-            return kwargs
-        model, varnames, modelfun = exp_model(x, y, **kwargs)
         log = 'log'
     
     elif 'poly' in ftype:
-        order = int(ftype[4:])
         a1 = next((value for key, value in kwargs.items() if key == 'a1'), None)
         if not a1:
             a10 = (y.max() - y[0]) / x.max()
             kwargs['a1'] = [a10, a10 / 4 + 20]
-        if return_inis:
-            return kwargs
-        model, varnames, modelfun = poly_model(x, y, order, **kwargs)
 
     elif 'logis' in ftype or 'scurve' in ftype or 'sigmoid' in ftype:
         peak = next((value for key, value in kwargs.items() if key == 'peak'), None)
@@ -105,42 +313,58 @@ def forecast(country,
             kwargs['peak'] = [peak0, peak0 / 4]
         shifted = next((value for key, value in kwargs.items() if key == 'shifted'), None)
         if shifted is None:
-            kwargs['shifted'] = [x[temp.cases.idxmax()], x.max() / 5]
-        if return_inis:
-            return kwargs
-        model, varnames, modelfun = logistic_model(x, y, **kwargs)
+            # the peak so far - days after the window are not known at its end, e.g. in a backtest
+            known = np.searchsorted(series['x'], x.max(), side='right')
+            kwargs['shifted'] = [series['x'][np.argmax(series['cases'][:known])], x.max() / 5]
     else:
         return None
 
-    with model:
-        step = pm.Slice()
-        trace = pm.sample(samples, step=step, tune=tune, chains=chains, cores=cpu_cores)  # , step, tune=2500, cores=10)
-
-    varstats = []
-    for va in varnames + ['sigma']:
-        stats = calculateStats(trace[va])  # mean 2, std 3, 20% 5, 80% 7
-        varstats.append([stats[2], stats[3], stats[5], stats[7]])
-
-    sigma = sum(calculateStats(trace['sigma'])[2:4])  # mean + std
-
-    plotstrs = ['%s COVID-19 cases %s model'%(country, ftype),
-                '%s to %s'%(datetime.datetime.strftime(startdate, '%d.%m.%Y'),
-                            datetime.datetime.strftime(enddate, '%d.%m.%Y')),
-                'cumulative cases']
-    df = modelfit_eval_dates(y, x, temp_new.dates,
-                       modelfun,
-                       varstats[0:-1],
-                       sigma=sigma,
-                       target=xTarget,
-                       plotstrs=plotstrs,
-                       log=log,
-                       varnames=varnames)
-
-    for va in varnames + ['sigma']:
-        stats = calculateStats(trace[va])
+    return log
+
+
+def _evaluate(trace, varnames, modelfun, x, y, xTarget=None, quantiles=(0.1, 0.9), band_draws=4000, stats_chunk=None):
+
+    """
+    fit metrics, prediction and parameter statistics of a posterior
+
+    :param trace: dict of variable name: array of draws, including "sigma"
+    :param varnames: model parameter names in the order of modelfun parameters
+    :param modelfun: model function
+    :param x: days of the window
+    :param y: cumulative cases of the window
+    :param xTarget: day of the prediction or None
+    :param quantiles: quantiles of the posterior predictive at the target
+    :param band_draws: number of posterior draws used for the quantiles
+    :param stats_chunk: number of variables read into memory at a time for the statistics, see trace_stats()
+    :return: result dataframe, fitted curves for plot_modelfit() and sigma (mean + std)
+    """
+
+    from .utils import trace_stats, modelfit_eval, predictive_bands
+
+    allstats = trace_stats(trace, varnames + ['sigma'], chunk=stats_chunk)  # mean 2, std 3, 20% 5, 80% 7
+    varstats = [[stats[2], stats[3], stats[5], stats[7]] for stats in allstats.values()]
+
+    sigma = sum(allstats['sigma'][2:4])  # mean + std
+
+    df, fit = modelfit_eval(y, x, modelfun, varstats[0:-1], sigma=sigma, target=xTarget, varnames=varnames)
+
+    # joint posterior predictive bands instead of varying one parameter at a time
+    quantiles = sorted(quantiles)
+    # seeded noise - identical inputs give identical results, as the result cache expects
+    low, high = predictive_bands(modelfun, trace, varnames, fit['x'], quantiles=[quantiles[0], quantiles[-1]],
+                                 noise='sigma', draws=band_draws, random_seed=0)
+    fit['band'] = (low, high, '%g-%g%% posterior predictive' % (quantiles[0] * 100, quantiles[-1] * 100))
+    if xTarget is not None:
+        row = 'prediction' if 'prediction' in df.index else 'target_fit'
+        target_band = predictive_bands(modelfun, trace, varnames, xTarget, quantiles=quantiles,
+                                       noise='sigma', draws=band_draws, random_seed=0)
+        for q, value in zip(quantiles, target_band[:, 0]):
+            df.loc['%s_%g%%' % (row, q * 100)] = value
+
+    for va, stats in allstats.items():
         df.loc[va + '_mean'] = stats[2]
         df.loc[va + '_std'] = stats[3]
         #df.loc[va + '_20%'] = stats[5]
         #df.loc[va + '_80%'] = stats[7]
 
-    return df
\ No newline at end of file
+    return df, fit, sigma
@@ -14,29 +14,37 @@ def exp_model(x, y, expo=[0.2, 1], slope=[5, 10], intercept=[0, 30], sigma0=20):
     import pymc3 as pm
     import numpy as np
 
+    values = _exp_data(x, y, expo, slope, intercept, sigma0)
+
     with pm.Model() as exp_m:  # or exp_model = pm.Model()
         # model y ~ theta_1* exp(theta_2*x) + theta_3
+        # data and priors are shared containers so that the model can be reused, see cached_model()
+        data = {name: pm.Data(name, value) for name, value in values.items()}
+        x = data['x']
 
         # Intercept  - theta_3
-        intercept = pm.Normal('intercept', mu=intercept[0], sd=intercept[1])
+        intercept = pm.Normal('intercept', mu=data['intercept_prior'][0], sd=data['intercept_prior'][1])
         # Slope   - theta_2
-        slope = pm.Normal('slope', mu=slope[0], sd=slope[1])
+        slope = pm.Normal('slope', mu=data['slope_prior'][0], sd=data['slope_prior'][1])
         # Exponent  - theta_1
-        expo = pm.Normal('expo', mu=expo[0], sd=expo[1])
+        expo = pm.Normal('expo', mu=data['expo_prior'][0], sd=data['expo_prior'][1])
         # Estimate of mean
         mean = slope * np.exp(expo * x) + intercept
 
         # Standard deviation
-        sigma = pm.HalfNormal('sigma', sd=sigma0)
+        sigma = pm.HalfNormal('sigma', sd=data['sigma0'])
         # Observed values
-        Y_obs = pm.Normal('Y_obs', mu=mean, sd=sigma, observed=y)
-
-    varnames = ['intercept', 'slope', 'expo']
+        Y_obs = pm.Normal('Y_obs', mu=mean, sd=sigma, observed=data['y'])
 
-    modelfun = lambda x1, y1: x1[0] + x1[1] * np.exp(x1[2] * y1)  # y is data
+    varnames, modelfun = model_functions('exp')
     return exp_m, varnames, modelfun
 
 
+def _exp_data(x, y, expo=[0.2, 1], slope=[5, 10], intercept=[0, 30], sigma0=20):
+
+    return _as_data(x=x, y=y, expo_prior=expo, slope_prior=slope, intercept_prior=intercept, sigma0=sigma0)
+
+
 def logistic_model(x, y, peak=[2e5, 1.8e5], shifted=[20, 8], expo=[0.3, 0.1], intercept=[0, 30], sigma0=20):
     """
     Logistic model (S-curve, simpler sigmoid function)
@@ -55,31 +63,101 @@ def logistic_model(x, y, peak=[2e5, 1.8e5], shifted=[20, 8], expo=[0.3, 0.1], in
     import pymc3 as pm
     import numpy as np
 
+    values = _logistic_data(x, y, peak, shifted, expo, intercept, sigma0)
+
     with pm.Model() as logistic_m:  # or exp_model = pm.Model()
         # model y ~ theta_1/(1+ exp(-theta_2*x +theta_2*theta_3) ) + theta_4
+        # data and priors are shared containers so that the model can be reused, see cached_model()
+        data = {name: pm.Data(name, value) for name, value in values.items()}
+        x = data['x']
 
         # Intercept  - theta_4
-        intercept = pm.Normal('intercept', mu=intercept[0], sd=intercept[1])
+        intercept = pm.Normal('intercept', mu=data['intercept_prior'][0], sd=data['intercept_prior'][1])
         # Peak   - theta_1
-        peak = pm.Normal('peak', mu=peak[0], sd=peak[1])
+        peak = pm.Normal('peak', mu=data['peak_prior'][0], sd=data['peak_prior'][1])
         # Exponent  - theta_2
-        expo = pm.Normal('expo', mu=expo[0], sd=expo[1])
+        expo = pm.Normal('expo', mu=data['expo_prior'][0], sd=data['expo_prior'][1])
         # Shifted - theta_3
-        shifted = pm.Normal('shifted', mu=shifted[0], sd=shifted[1])
+        shifted = pm.Normal('shifted', mu=data['shifted_prior'][0], sd=data['shifted_prior'][1])
         # Estimate of mean
         mean = peak / ( 1 + np.exp( -expo * x + expo * shifted ) ) + intercept
 
         # Standard deviation
-        sigma = pm.HalfNormal('sigma', sd=sigma0)
+        sigma = pm.HalfNormal('sigma', sd=data['sigma0'])
         # Observed values
-        Y_obs = pm.Normal('Y_obs', mu=mean, sd=sigma, observed=y)
-
-    varnames = ['intercept', 'peak', 'expo', 'shifted']
+        Y_obs = pm.Normal('Y_obs', mu=mean, sd=sigma, observed=data['y'])
 
-    modelfun = lambda x1, y1: x1[0] + x1[1] /(1+  np.exp( -x1[2] * y1  + x1[2] * x1[3] ) )  # y is data
+    varnames, modelfun = model_functions('logistic')
     return logistic_m, varnames, modelfun
 
 
+def _logistic_data(x, y, peak=[2e5, 1.8e5], shifted=[20, 8], expo=[0.3, 0.1], intercept=[0, 30], sigma0=20):
+
+    return _as_data(x=x, y=y, peak_prior=peak, shifted_prior=shifted, expo_prior=expo,
+                    intercept_prior=intercept, sigma0=sigma0)
+
+
+def hierarchical_model(ftype, group, x, y, expo=None, peak=[1.5, 0.5], sigma0=0.1, **priors):
+    """
+    exp or logistic model of many countries fitted at once
+    The data of all countries is stacked into one array, each point tagged with the index of its
+    country. The exponents (and the peaks of the logistic model) of the countries are drawn from
+    shared hyperpriors, so that countries with little data borrow strength from the others. The
+    data of each country should be scaled to about 1, e.g. divided by its maximum.
+    :param ftype: 'exp' or 'logistic'
+    :param group: index of the country of each datapoint
+    :param x: datapoints
+    :param y: scaled data
+    :param expo: mean exponent of the countries [mu and sigma] - sigma is on the log scale
+    :param peak: mean peak of the logistic model relative to the scaled data [mu and sigma] - sigma is on the log scale
+    :param sigma0: the general variation of the scaled result
+    :param **priors: [mu, sigma] per country as arrays of shape (2, countries) - intercept and slope for
+                     the exp model, intercept and shifted for the logistic model
+    :return: returns the model, list of model parameter names as strings (each a vector over the countries)
+             and model function
+    """
+
+    import pymc3 as pm
+    import numpy as np
+
+    group = np.asarray(group, dtype=int)
+    countries = group.max() + 1
+    priors = {name: np.asarray(value, dtype=float) for name, value in priors.items()}
+    if expo is None:
+        expo = [0.2, 1] if ftype == 'exp' else [0.3, 0.5]
+
+    with pm.Model() as hierarchical_m:
+        # exponent of each country around the common one - centered, the data of a country
+        # usually determines its own exponent well
+        expo_mu = pm.Normal('expo_mu', mu=np.log(expo[0]), sd=expo[1])
+        expo_sd = pm.Gamma('expo_sd', alpha=2, beta=10)
+        expo_log = pm.Normal('expo_log', mu=expo_mu, sd=expo_sd, shape=countries)
+        expo_c = pm.Deterministic('expo', np.exp(expo_log))
+
+        intercept = pm.Normal('intercept', mu=priors['intercept'][0], sd=priors['intercept'][1], shape=countries)
+
+        if ftype == 'exp':
+            slope = pm.Normal('slope', mu=priors['slope'][0], sd=priors['slope'][1], shape=countries)
+            mean = slope[group] * np.exp(expo_c[group] * x) + intercept[group]
+            varnames, modelfun = model_functions('exp')
+
+        else:
+            peak_mu = pm.Normal('peak_mu', mu=np.log(peak[0]), sd=peak[1])
+            peak_sd = pm.Gamma('peak_sd', alpha=2, beta=10)
+            peak_log = pm.Normal('peak_log', mu=peak_mu, sd=peak_sd, shape=countries)
+            peak_c = pm.Deterministic('peak', np.exp(peak_log))
+            shifted = pm.Normal('shifted', mu=priors['shifted'][0], sd=priors['shifted'][1], shape=countries)
+            mean = peak_c[group] / ( 1 + np.exp( -expo_c[group] * x + expo_c[group] * shifted[group] ) ) + intercept[group]
+            varnames, modelfun = model_functions('logistic')
+
+        # Standard deviation of each country
+        sigma = pm.HalfNormal('sigma', sd=sigma0, shape=countries)
+        # Observed values
+        Y_obs = pm.Normal('Y_obs', mu=mean, sd=sigma[group], observed=y)
+
+    return hierarchical_m, varnames, modelfun
+
+
 # noinspection PyIncorrectDocstring
 def poly_model(x, y, order, intercept=[0, 20], sigma0=30, **kwargs):
     """
@@ -87,6 +165,7 @@ def poly_model(x, y, order, intercept=[0, 20], sigma0=30, **kwargs):
     **kwargs allows any number of key word arguments
     The polynomial function is intercept + a1*x + a2*x**2 + a3*x**3 + ...
     Order N of the polynomial gives the last aN multiplier
+    The multipliers are one vector "a" against the design matrix of x powers, reported as a1, a2, ... aN
     :param x: datapoints
     :param y: data
     :param order: order of the polynomial  0, 1, 2, ...
@@ -102,63 +181,233 @@ def poly_model(x, y, order, intercept=[0, 20], sigma0=30, **kwargs):
     import pymc3 as pm
     from .utils import poly_fun
 
-    args = []
-    argvals = []
-    for oi in range(1, order + 1):
-        aN = 'a' + str(oi)
-        args.append(aN)
-        isinargs = next((value for key, value in kwargs.items() if key == aN), None)
-        if not isinargs:
-            argvals.append([0, 30 / oi**4])
-            exec('%s = [%f, %f]'%(aN, argvals[-1][0], argvals[-1][1]))
-        else:
-            argvals.append(isinargs)
-
-    '''
-    if order == 1:
-        print('1st-order polynomial fit \n args: intercept,', args)
-    elif order == 0:
-        print('Constant fit')
-    elif order == 2:
-        print('2nd-order polynomial fit \n args: intercept', args)
-    else:
-        print('%dth-order polynomial fit \n args: intercept,'%order, args)
-    '''
+    values = _poly_data(x, y, order, intercept, sigma0, **kwargs)
 
     with pm.Model() as poly_m:  # or exp_model = pm.Model()
         # model y ~ a1*x + a2*x**2 + a3*x**3 +.. + intercept
+        # data and priors are shared containers so that the model can be reused, see cached_model()
+        data = {name: pm.Data(name, value) for name, value in values.items()}
 
         # Intercept  - theta_3
-        intercept = pm.Normal('intercept', mu=intercept[0], sd=intercept[1])
+        intercept = pm.Normal('intercept', mu=data['intercept_prior'][0], sd=data['intercept_prior'][1])
         mean = intercept
         varnames = ['intercept']
-        # modelfun0 = lambda x1, y1: poly_fun(x, y, 0)  # y is data
-        if order>0:
-            a1 = pm.Normal('a1', mu=argvals[0][0], sd=argvals[0][1])
-            mean += a1*x
-            varnames.append('a1')
-        if order>1:
-            a2 = pm.Normal('a2', mu=argvals[1][0], sd=argvals[1][1])
-            mean += a2 * x**2
-            varnames.append('a2')
-        if order > 2:
-            a3 = pm.Normal('a3', mu=argvals[2][0], sd=argvals[2][1])
-            mean += a3 * x**3
-            varnames.append('a3')
-        oi = 3
-        while order > oi:
-
-            exec('%s = pm.Normal("a%d", mu=argvals[oi][0], sd=argvals[oi][1])'%(args[oi], oi + 1))
-            varnames.append('a%d'%(oi+1))
-
-            mean += eval('%s*x**%d' % (args[oi], oi+1))
-
-            oi += 1
+
+        if order > 0:
+            # all multipliers as one vector against the powers x, x**2, ... of the design matrix
+            a = pm.Normal('a', mu=data['a_prior'][0], sd=data['a_prior'][1], shape=order)
+            mean = mean + pm.math.dot(data['design'], a)
+            for oi in range(order):
+                pm.Deterministic('a%d' % (oi + 1), a[oi])
+                varnames.append('a%d' % (oi + 1))
 
         # Standard deviation
-        sigma = pm.HalfNormal('sigma', sd=sigma0)
+        sigma = pm.HalfNormal('sigma', sd=data['sigma0'])
         # Observed values
-        Y_obs = pm.Normal('Y_obs', mu=mean, sd=sigma, observed=y)
+        Y_obs = pm.Normal('Y_obs', mu=mean, sd=sigma, observed=data['y'])
 
     modelfun = poly_fun  
-    return poly_m, varnames, modelfun
\ No newline at end of file
+    return poly_m, varnames, modelfun
+
+
+def _poly_data(x, y, order, intercept=[0, 20], sigma0=30, **kwargs):
+
+    import numpy as np
+
+    values = {'y': y, 'intercept_prior': intercept, 'sigma0': sigma0}
+    if order > 0:
+        priors = []
+        for oi in range(1, order + 1):
+            aN = 'a' + str(oi)
+            isinargs = next((value for key, value in kwargs.items() if key == aN), None)
+            if not isinargs:
+                priors.append([0, 30 / oi**4])
+            else:
+                priors.append(isinargs)
+        # rows of mu and sigma of the a1, a2, ... multipliers
+        values['a_prior'] = np.transpose(priors)
+        # columns x, x**2, ..., x**order
+        values['design'] = np.vander(np.asarray(x, dtype=float), order + 1, increasing=True)[:, 1:]
+
+    return _as_data(**values)
+
+
+def _as_data(**values):
+
+    import numpy as np
+
+    # float arrays throughout so that later set_data() calls keep the dtype of the containers
+    return {name: np.asarray(value, dtype=float) for name, value in values.items()}
+
+
+_model_cache = {}
+
+
+def model_key(ftype):
+
+    """
+    cache key of a model type
+
+    :param ftype: 'polyN', 'exp' or 'logistic' (also 'scurve' or 'sigmoid') as in forecast()
+    :return: (model name, polynomial order or None), or None for unknown types
+    """
+
+    if ftype == 'exp':
+        return 'exp', None
+    if 'poly' in ftype:
+        return 'poly', int(ftype[4:])
+    if 'logis' in ftype or 'scurve' in ftype or 'sigmoid' in ftype:
+        return 'logistic', None
+
+    return None
+
+
+def model_functions(ftype):
+
+    """
+    parameter names and model function of a model type, without building the model
+
+    :param ftype: 'polyN', 'exp' or 'logistic' as in forecast()
+    :return: list of model parameter names and model function as from cached_model() - None for unknown types
+    """
+
+    from .utils import poly_fun, exp_fun, logistic_fun
+
+    key = model_key(ftype)
+    if key is None:
+        return None
+
+    name, order = key
+    if name == 'exp':
+        return ['intercept', 'slope', 'expo'], exp_fun
+    if name == 'poly':
+        return ['intercept'] + ['a%d' % (oi + 1) for oi in range(order)], poly_fun
+
+    return ['intercept', 'peak', 'expo', 'shifted'], logistic_fun
+
+
+def cached_model(ftype, x, y, **kwargs):
+
+    """
+    model of the given type with new data and priors swapped into a cached model
+
+    The first call for a (model, order) key builds the model, later calls only set
+    the shared data containers, so the compiled Theano functions of the model and of
+    the step methods from cached_step() are reused between countries and date windows.
+
+    :param ftype: 'polyN', 'exp' or 'logistic' as in forecast()
+    :param x: datapoints
+    :param y: data
+    :param **kwargs: model priors as in exp_model(), logistic_model() or poly_model()
+    :return: model, list of model parameter names and model function - None for unknown types
+    """
+
+    import numpy as np
+    import pymc3 as pm
+
+    key = model_key(ftype)
+    if key is None:
+        return None
+
+    name, order = key
+
+    if key not in _model_cache:
+        if name == 'exp':
+            built = exp_model(x, y, **kwargs)
+        elif name == 'poly':
+            built = poly_model(x, y, order, **kwargs)
+        else:
+            built = logistic_model(x, y, **kwargs)
+        # the test values in the graph keep the shapes of the first data - graphs compiled
+        # later (gradients, step methods) must not be checked against them
+        built[0]._theano_config = {'compute_test_value': 'off'}
+        _model_cache[key] = {'model': built, 'compiled': {}}
+        return built
+
+    model, varnames, modelfun = _model_cache[key]['model']
+
+    if name == 'exp':
+        values = _exp_data(x, y, **kwargs)
+    elif name == 'poly':
+        values = _poly_data(x, y, order, **kwargs)
+    else:
+        values = _logistic_data(x, y, **kwargs)
+
+    pm.set_data(values, model=model)
+
+    # start the chains from the new prior means, not from the ones the model was built with
+    for var in model.free_RVs:
+        if var.name + '_prior' in values:
+            var.tag.test_value = np.asarray(values[var.name + '_prior'][0], dtype=var.dtype)
+
+    return model, varnames, modelfun
+
+
+def cached_step(ftype, step, **kwargs):
+
+    """
+    step method of a cached model, created once per model and step type
+
+    Chains run in this process (cores=1) adapt the step method itself - the slice widths of
+    Slice, the mass matrix and step size of NUTS. The step method is returned in the state it
+    was created in, so a fit does not start from the adaptation to the previous country or window.
+
+    :param ftype: 'polyN', 'exp' or 'logistic' as in forecast() - cached_model() must be called first
+    :param step: step method class, e.g. pymc3.Slice
+    :param **kwargs: arguments of the step method when it is created
+    :return: step method instance
+    """
+
+    method = cached_function(ftype, step, lambda model: _keep_initial_state(step(model=model, **kwargs)))
+    _restore_initial_state(method)
+
+    return method
+
+
+# adapted attributes of the step methods: Slice widths, NUTS mass matrix and step size, and whether
+# they tune - the parallel chains of pm.sample() start from the step method as it is
+_ADAPTED = ('tune', 'w', 'n_tunes', 'potential', 'step_adapt')
+
+
+def _keep_initial_state(method):
+
+    import copy
+
+    # a Slice of many variables is a CompoundStep of one Slice per variable
+    for part in getattr(method, 'methods', [method]):
+        part._initial_state = {name: copy.deepcopy(getattr(part, name)) for name in _ADAPTED if hasattr(part, name)}
+
+    return method
+
+
+def _restore_initial_state(method):
+
+    import copy
+
+    for part in getattr(method, 'methods', [method]):
+        for name, value in part._initial_state.items():
+            setattr(part, name, copy.deepcopy(value))
+        if hasattr(part, 'integrator'):
+            # the leapfrog integrator of NUTS holds the potential
+            part.integrator._potential = part.potential
+
+
+def cached_function(ftype, name, factory):
+
+    """
+    compiled function of a cached model, created once per model and name
+
+    :param ftype: 'polyN', 'exp' or 'logistic' as in forecast() - cached_model() must be called first
+    :param name: name of the function in the cache
+    :param factory: function of the model that compiles the function
+    :return: output of factory(model)
+    """
+
+    import theano
+
+    entry = _model_cache[model_key(ftype)]
+    if name not in entry['compiled']:
+        with theano.config.change_flags(compute_test_value='off'):
+            entry['compiled'][name] = factory(entry['model'][0])
+
+    return entry['compiled'][name]
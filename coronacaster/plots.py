@@ -1,48 +1,33 @@
 def plot_country(country, data, log='lin', end=None, start=None, limit=0):
-    
+
     """
     plot the cases of given country
-    
+
     :param country: Country name, if there is "countries" column in the data - else use "World or "" for all data
     :param data: dataframe with "dates" (datetime) and "cases" columns - coses is the number of daily new cases
+                 or a CountrySeriesIndex built from it
     :param log: 'log' if logarithmic plot
     :param end:  end datetime to plot x-range
     :param start: start datetime
     :param limit: first date when there is more than given value of cumulative cases
     :return:
     """
-    
+
+    import pandas as pd
     import matplotlib.pyplot as plt
     import matplotlib.ticker as ticker
     import seaborn as sns
 
-    if country=='all' or country=='World' or len(country)==0:
-        temp = data.sort_values('dates')
-    else:
-        temp = data[data.countries == country].sort_values('dates')
-
-    temp['cumcases']=temp.cases.cumsum().values
-    temp['cumdeaths']=temp.deaths.cumsum().values
-    first_date2 = next((ti['dates'] for ind, ti in temp.iterrows() if ti['cumcases'] > limit), None)
-    
-    if first_date2 == None:
+    panel = _panel(country, data, start=start, end=end, limit=limit)
+    if panel is None:
         #print('no cumulative cases over the limit %f for country '%limit, country)
         return
-    
-    if not(start is None):
-        first_date2 = max(start, first_date2)
-    
-    temp = temp[temp.dates>= first_date2]
-    if end is None:
-        end = temp.dates.max()
-        #print('date range with non-zero data: \n', first_date2, '-', end)
-    else:
-        #print('date range with non-zero data: \n', first_date2, '-', end)
-        temp = temp[temp.date <= end]
+
+    dates, cumcases, cumdeaths = panel
 
     fig, ax = plt.subplots(figsize=[12, 8])
-    plt.plot_date(temp.dates, temp.cumcases.values, '', linewidth=3.5, label='cases', color='#005082', alpha=.5)
-    plt.plot_date(temp.dates, temp.cumdeaths.values, '', linewidth=3, label='deaths', color='#FF1053', alpha=.5)
+    plt.plot_date(dates, cumcases, '', linewidth=3.5, label='cases', color='#005082', alpha=.5)
+    plt.plot_date(dates, cumdeaths, '', linewidth=3, label='deaths', color='#FF1053', alpha=.5)
 
 
     if log == "log":
@@ -61,4 +46,162 @@ def plot_country(country, data, log='lin', end=None, start=None, limit=0):
 
     sns.despine()
 
-    return first_date2
+    return pd.Timestamp(dates[0]) if len(dates) else None
+
+
+def plot_countries(countries, data, path=None, log='lin', end=None, start=None, limit=0, nrows=4, ncols=4,
+                   dpi=100, workers=None):
+
+    """
+    plot the cases of many countries as small multiples, nrows x ncols countries per page
+
+    The pages are drawn on the Agg canvas without pyplot, so no figures are left open.
+    When writing to files, one figure is drawn and its axes and lines are reused page by
+    page. Countries without cumulative cases over the limit are left out.
+
+        coronacaster.plot_countries(index.countries, index, 'countries.pdf')
+
+    :param countries: country names as in plot_country()
+    :param data: dataframe or CountrySeriesIndex as in plot_country()
+    :param path: .pdf file to write all pages to, or .png file name - "{page}" in it is replaced by the page
+                 number, else the number is added before the suffix. None returns the figures instead
+    :param log: 'log' if logarithmic plots
+    :param end: end datetime to plot x-range
+    :param start: start datetime
+    :param limit: first date when there is more than given value of cumulative cases
+    :param nrows: rows of plots per page
+    :param ncols: columns of plots per page
+    :param dpi: resolution of .png pages
+    :param workers: number of processes drawing .png pages at the same time - a .pdf is drawn in this process
+    :return: list of the written files, or of the figures without path
+    """
+
+    import os
+    import functools
+    from concurrent.futures import ProcessPoolExecutor
+
+    panels = []
+    for country in countries:
+        panel = _panel(country, data, start=start, end=end, limit=limit)
+        if panel is not None:
+            panels.append((country,) + panel)
+
+    size = nrows * ncols
+    pages = [(number + 1, panels[first:first + size]) for number, first in enumerate(range(0, len(panels), size))]
+
+    if path is None:
+        figures = []
+        for page in pages:
+            figure = _page_figure(nrows, ncols, log)
+            _draw_page(figure, page[1])
+            figures.append(figure[0])
+        return figures
+
+    if path.lower().endswith('.pdf'):
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        figure = _page_figure(nrows, ncols, log)
+        with PdfPages(path) as pdf:
+            for number, page in pages:
+                _draw_page(figure, page)
+                pdf.savefig(figure[0])
+        return [path]
+
+    if '{page}' not in path:
+        root, suffix = os.path.splitext(path)
+        path = root + '-{page}' + suffix
+
+    if not workers or workers < 2 or len(pages) < 2:
+        return _write_pages(pages, path, log, nrows, ncols, dpi)
+
+    workers = min(workers, len(pages))
+    write = functools.partial(_write_pages, path=path, log=log, nrows=nrows, ncols=ncols, dpi=dpi)
+    with ProcessPoolExecutor(workers) as pool:
+        parts = list(pool.map(write, [pages[worker::workers] for worker in range(workers)]))
+
+    return sorted(name for part in parts for name in part)
+
+
+def _panel(country, data, start=None, end=None, limit=0):
+
+    import numpy as np
+    import pandas as pd
+    from .series import country_arrays, first_over
+
+    series = country_arrays(country, data)
+    dates = series['dates']
+
+    first = first_over(series['cumcases'], limit)
+    if first == len(dates):
+        return None
+
+    if start is not None:
+        first = max(first, np.searchsorted(dates, np.datetime64(pd.Timestamp(start), 'ns'), side='left'))
+    last = len(dates) if end is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end), 'ns'), side='right')
+
+    return dates[first:last], series['cumcases'][first:last], series['cumdeaths'][first:last]
+
+
+def _page_figure(nrows, ncols, log):
+
+    import matplotlib.dates as mdates
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=[4 * ncols, 3 * nrows])
+    figure.subplots_adjust(left=0.06, right=0.98, bottom=0.06, top=0.95, wspace=0.3, hspace=0.4)
+    FigureCanvasAgg(figure)
+
+    axes = figure.subplots(nrows, ncols, squeeze=False).ravel()
+    lines = []
+    for ax in axes:
+        cases, = ax.plot([], [], linewidth=2, label='cases', color='#005082', alpha=.5)
+        deaths, = ax.plot([], [], linewidth=2, label='deaths', color='#FF1053', alpha=.5)
+        lines.append((cases, deaths))
+
+        if log == 'log':
+            ax.set_yscale('log')
+        locator = mdates.AutoDateLocator()
+        ax.xaxis.set_major_locator(locator)
+        ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+        ax.tick_params(labelsize=8)
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+
+    axes[0].legend(loc='upper left', fontsize=8)
+
+    return figure, axes, lines
+
+
+def _draw_page(figure, panels):
+
+    import matplotlib.dates as mdates
+
+    _, axes, lines = figure
+    for ai, (ax, (cases, deaths)) in enumerate(zip(axes, lines)):
+        if ai >= len(panels):
+            ax.set_visible(False)
+            continue
+
+        country, dates, cumcases, cumdeaths = panels[ai]
+        days = mdates.date2num(dates)
+        cases.set_data(days, cumcases)
+        deaths.set_data(days, cumdeaths)
+        ax.set_title(country, fontsize=10)
+        ax.set_visible(True)
+        ax.relim()
+        ax.autoscale_view()
+
+
+def _write_pages(pages, path, log, nrows, ncols, dpi):
+
+    figure = _page_figure(nrows, ncols, log)
+
+    written = []
+    for number, page in pages:
+        _draw_page(figure, page)
+        name = path.format(page='%03d' % number)
+        figure[0].savefig(name, dpi=dpi)
+        written.append(name)
+
+    return written
@@ -0,0 +1,144 @@
+class Profile:
+
+    """
+    wall time, CPU time and peak memory of the stages of a forecast
+
+    Every stage is a dict of its name, the labels of the profile, "wall" and "cpu" seconds,
+    "peak_rss" bytes and stage specific values. A stage with "draws" (per chain) and "chains"
+    also gets "draws_per_second" and "draws_per_second_per_chain".
+    The CPU time includes finished child processes, like parallel chains. The peak RSS is
+    the high-water mark of the process, or of its largest finished child, at the end of the
+    stage - so it only grows from stage to stage. Without the resource module (Windows) the
+    CPU time is of this process only and the peak RSS is None.
+
+        df, profile = coronacaster.forecast('Finland', index, profile=True)
+        profile.frame()
+
+    :param hook: function called with every stage dict when the stage ends, e.g. to send it to a metrics system
+    :param **labels: values added to every stage, e.g. country and ftype
+    """
+
+    def __init__(self, hook=None, **labels):
+
+        self.hook = hook
+        self.labels = labels
+        self.stages = []
+
+    def stage(self, name, **info):
+
+        """
+        context manager that measures a stage
+
+            with profile.stage('plot'):
+                ...
+
+        :param name: stage name
+        :param **info: values stored with the stage - more can be added to the returned dict inside the block
+        :return: the stage dict, filled in when the block ends
+        """
+
+        return _Stage(self, dict(self.labels, stage=name, **info))
+
+    def frame(self):
+
+        """
+        :return: dataframe of the stages, one row each
+        """
+
+        import pandas as pd
+
+        return pd.DataFrame(self.stages)
+
+    @property
+    def wall(self):
+
+        return sum(stage['wall'] for stage in self.stages)
+
+    def __repr__(self):
+
+        return 'Profile(%s, %d stages, %.3f s)' % (', '.join('%s=%s' % item for item in self.labels.items()),
+                                                   len(self.stages), self.wall)
+
+
+class _Stage:
+
+    def __init__(self, profile, record):
+
+        self.profile = profile
+        self.record = record
+
+    def __enter__(self):
+
+        import time
+
+        self.cpu = _cpu_time()
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, kind, value, traceback):
+
+        import time
+
+        self.record.update(wall=time.perf_counter() - self.start, cpu=_cpu_time() - self.cpu,
+                           peak_rss=_peak_rss())
+        if kind is not None:
+            self.record['error'] = repr(value)
+        if 'draws' in self.record and self.record['wall'] > 0:
+            rate = self.record['draws'] / self.record['wall']
+            self.record.update(draws_per_second=rate * self.record.get('chains', 1), draws_per_second_per_chain=rate)
+
+        self.profile.stages.append(self.record)
+        if self.profile.hook is not None:
+            self.profile.hook(self.record)
+
+        return False
+
+
+def draw_counts(posterior):
+
+    """
+    number of chains and draws per chain of a posterior, for the stage dict of a sampling stage
+
+        with profile.stage('sample') as stage:
+            trace = ...
+            stage.update(draw_counts(trace))
+
+    :param posterior: dict of variable name: array of draws of shape (chains, draws)
+    :return: dict of "chains" and "draws"
+    """
+
+    import numpy as np
+
+    chains, draws = (np.shape(next(iter(posterior.values()))) + (1, 1))[:2]
+
+    return {'chains': chains, 'draws': draws}
+
+
+def _cpu_time():
+
+    import time
+
+    try:
+        import resource
+    except ImportError:
+        return time.process_time()
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss():
+
+    import sys
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
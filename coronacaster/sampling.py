@@ -0,0 +1,502 @@
+def posterior_from_trace(trace, names):
+
+    """
+    draws of a pymc3 trace as a posterior dict
+
+    :param trace: pymc3 MultiTrace
+    :param names: variable names to take
+    :return: dict of variable name: array of shape (chains, draws)
+    """
+
+    import numpy as np
+
+    return {name: np.asarray(trace.get_values(name, combine=False)) for name in names}
+
+
+def summary_from_result(previous, names):
+
+    """
+    posterior means and standard deviations from a previous forecast() result
+
+    :param previous: forecast() result (dataframe or its first column as a series or dict with
+                     "<name>_mean" and "<name>_std" entries), or dict of name: [mean, std]
+    :param names: variable names to take
+    :return: dict of variable name: (mean, std)
+    """
+
+    if getattr(previous, 'ndim', 1) == 2:
+        previous = previous.iloc[:, 0]
+
+    summary = {}
+    for name in names:
+        if name + '_mean' in previous:
+            summary[name] = (float(previous[name + '_mean']), float(previous[name + '_std']))
+        else:
+            summary[name] = (float(previous[name][0]), float(previous[name][1]))
+
+    return summary
+
+
+def warm_start(model, summary, chains, random_seed=None):
+
+    """
+    start points of the chains around a previous posterior
+
+    The previous means also become the test point of the model, where fit_map()
+    and fit_advi() start from.
+
+    :param model: pymc3 model
+    :param summary: dict of variable name: (mean, std), e.g. from summary_from_result()
+    :param chains: number of chains
+    :param random_seed: seed of the start points
+    :return: list of start points, one per chain
+    """
+
+    import numpy as np
+    from pymc3.util import update_start_vals
+
+    summary = _free_summary(model, summary)
+    point = {name: mean for name, (mean, std) in summary.items()}
+    update_start_vals(point, model.test_point, model)
+    for var in model.free_RVs:
+        var.tag.test_value = np.asarray(point[var.name], dtype=var.dtype)
+
+    rng = np.random.RandomState(random_seed)
+    starts = []
+    for chain in range(chains):
+        start = {}
+        for name, (mean, std) in summary.items():
+            if hasattr(model[name], 'transformation'):
+                # bounded (positive) variable - jitter it on the log scale
+                start[name] = mean * np.exp(std / np.abs(mean) * rng.randn(*np.shape(mean)))
+            else:
+                start[name] = mean + std * rng.randn(*np.shape(mean))
+        starts.append(start)
+
+    return starts
+
+
+def _free_summary(model, summary):
+
+    import numpy as np
+    from pymc3.util import get_untransformed_name, is_transformed_name
+
+    # vector variables, e.g. the multipliers "a" of the polynomial models, are reported
+    # as numbered scalars a1, a2, ... - collect them back into vectors
+    free = {}
+    for var in model.free_RVs:
+        name = get_untransformed_name(var.name) if is_transformed_name(var.name) else var.name
+        if name in summary:
+            free[name] = summary[name]
+        else:
+            parts = [summary['%s%d' % (name, i + 1)] for i in range(np.size(var.tag.test_value))]
+            free[name] = (np.array([mean for mean, std in parts]), np.array([std for mean, std in parts]))
+
+    return free
+
+
+def sample_mcmc(model, step, names, samples=10000, tune=2000, chains=20, cores=4,
+                target_rhat=None, target_ess=None, chunk=1000, start=None, thin=1, dtype=None,
+                trace_dir=None, counts=None):
+
+    """
+    draw from the posterior with a step method, optionally until the chains have converged
+
+    Without targets or storage options all samples are drawn at once. Otherwise the draws
+    are made in chunks, continuing each chain from its last point. With a target R-hat and/or
+    effective sample size the sampling stops as soon as all variables reach the targets (or
+    samples is reached). NUTS is tuned in the first chunk only - later chunks use its adapted
+    step size and mass matrix.
+
+    Every chunk is thinned and converted to dtype as it is drawn, so only one chunk of the
+    full trace is in memory at a time. With trace_dir the kept draws are written to .npy
+    files there and the returned arrays are memory maps of them.
+
+    :param model: pymc3 model
+    :param step: step method instance, e.g. from models.cached_step()
+    :param names: variable names to take
+    :param samples: number of samples per chain - the maximum with targets
+    :param tune: number of tuning steps per chain
+    :param chains: number of chains
+    :param cores: number of chains run in parallel
+    :param target_rhat: stop when the R-hat of every variable is at most this, e.g. 1.01
+    :param target_ess: stop when the bulk effective sample size of every variable is at least this
+    :param chunk: number of samples per chain drawn between the convergence checks
+    :param start: start point, or list of start points per chain, e.g. from warm_start()
+    :param thin: keep every thin-th draw
+    :param dtype: dtype of the kept draws, e.g. 'float32' - None keeps float64
+    :param trace_dir: directory to write the kept draws to, None keeps them in memory
+    :param counts: dict to fill with the number of "chains" and "draws" per chain made before thinning
+    :return: dict of variable name: array of shape (chains, draws)
+    """
+
+    import pymc3 as pm
+
+    if counts is None:
+        counts = {}
+
+    if target_rhat is None and target_ess is None and thin == 1 and dtype is None and trace_dir is None:
+        trace = pm.sample(samples, step=step, tune=tune, chains=chains, cores=cores, start=start, model=model)
+        counts.update(chains=chains, draws=samples)
+        return posterior_from_trace(trace, names)
+
+    posterior = None
+    drawn = 0
+    kept = 0
+    while drawn < samples:
+        draws = min(chunk, samples - drawn)
+        trace = pm.sample(draws, step=step, tune=tune if drawn == 0 else 0, chains=chains, cores=cores,
+                          start=start, model=model, compute_convergence_checks=False)
+
+        if drawn == 0 and isinstance(step, pm.NUTS):
+            keep_tuning(step, trace)
+
+        part = posterior_from_trace(trace, names)
+        if posterior is None:
+            size = -(-samples // thin)
+            posterior = {name: _trace_array(trace_dir, name, values.shape[:1] + (size,) + values.shape[2:], dtype)
+                         for name, values in part.items()}
+
+        # the thinning continues over the chunks
+        first = -drawn % thin
+        count = len(range(first, draws, thin))
+        for name in names:
+            posterior[name][:, kept:kept + count] = part[name][:, first::thin]
+        drawn += draws
+        kept += count
+        counts.update(chains=chains, draws=drawn)
+
+        if (target_rhat is not None or target_ess is not None) and \
+                converged({name: values[:, :kept] for name, values in posterior.items()}, target_rhat, target_ess):
+            break
+
+        start = [{var.name: trace.point(-1, chain=chain)[var.name] for var in model.free_RVs}
+                 for chain in trace.chains]
+
+    return {name: values[:, :kept] for name, values in posterior.items()}
+
+
+def _trace_array(directory, name, shape, dtype):
+
+    import os
+    import numpy as np
+
+    if directory is None:
+        return np.empty(shape, dtype=dtype or float)
+
+    return np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype or float,
+                                     shape=shape)
+
+
+def converged(posterior, target_rhat=None, target_ess=None):
+
+    """
+    check the R-hat and effective sample size of all variables against targets
+
+    :param posterior: dict of variable name: array of shape (chains, draws)
+    :param target_rhat: maximum R-hat, or None to skip - needs at least two chains
+    :param target_ess: minimum bulk effective sample size, or None to skip
+    :return: True if all variables reach the targets
+    """
+
+    import numpy as np
+    import arviz as az
+
+    data = az.convert_to_dataset(posterior)
+
+    if target_rhat is not None:
+        rhat = az.rhat(data).to_array().values
+        if not np.all(rhat <= target_rhat):
+            return False
+
+    if target_ess is not None:
+        ess = az.ess(data).to_array().values
+        if not np.all(ess >= target_ess):
+            return False
+
+    return True
+
+
+def keep_tuning(step, trace):
+
+    """
+    make the mass matrix and step size NUTS adapted in a trace the initial ones of the step method
+
+    pm.sample() resets a NUTS step method to its initial mass matrix and step size for every
+    chain, so later runs without tuning would start from scratch. The compiled functions of
+    the step method are kept - models.cached_step() restores its state before the next fit.
+
+    :param step: pymc3.NUTS instance that drew the trace
+    :param trace: pymc3 MultiTrace with tuning
+    """
+
+    import numpy as np
+    from pymc3.step_methods.hmc.quadpotential import quad_potential
+    from pymc3.step_methods.step_sizes import DualAverageAdaptation
+
+    variances = np.concatenate([np.var(trace.get_values(var.name), axis=0).ravel() for var in step.vars])
+    step_size = np.median([trace.get_sampler_stats('step_size', chains=chain)[-1] for chain in trace.chains])
+
+    adapt = step.step_adapt
+    step.potential = quad_potential(variances, True)
+    step.integrator._potential = step.potential
+    step.step_adapt = DualAverageAdaptation(step_size, adapt._target, adapt._gamma, adapt._k, adapt._t0)
+
+
+def conjugate_posterior(x, y, order, intercept=[0, 20], sigma0=30, grid=400, **kwargs):
+
+    """
+    posterior of a polynomial model by conjugate Bayesian linear regression
+
+    Given sigma, poly_model() is a linear regression with Normal priors on the intercept and
+    the multipliers a1..aN, so their posterior is exactly Normal. Sigma has a HalfNormal prior;
+    its marginal posterior is evaluated in closed form on a grid of log sigma around its mass.
+    The posterior of the multipliers is then the mixture of their Normal posteriors at the grid
+    points. The design matrix is scaled to unit columns and the covariances are factored in the
+scaled coefficients - unscaled, the covariance of x and x**8 terms is numerically singular.
+
+    :param x: datapoints
+    :param y: data
+    :param order: order of the polynomial 0, 1, 2, ...
+    :param intercept: the constant [mu, sigma] as in poly_model()
+    :param sigma0: general variation as in poly_model()
+    :param grid: number of grid points of sigma
+    :param **kwargs: multiplier priors a1=[mu, sigma], ... as in poly_model()
+    :return: dict of "sigma" grid points and their posterior "weights", the posterior "means" (grid, order + 1)
+             and "covs" (grid, order + 1, order + 1) of intercept, a1, ... aN given each grid point,
+             "factors" of the covs (factor @ factor.T = cov) to draw with, and the overall "mean" and "cov"
+    """
+
+    import numpy as np
+    from .models import _poly_data
+
+    values = _poly_data(x, y, order, intercept, sigma0, **kwargs)
+    y = values['y']
+    design = np.ones((len(y), 1))
+    priors = np.column_stack([values['intercept_prior']])
+    if order > 0:
+        design = np.column_stack([design, values['design']])
+        priors = np.column_stack([priors, values['a_prior']])
+
+    # in the scaled coefficients c = b * scale
+    scale = np.linalg.norm(design, axis=0)
+    scale[scale == 0] = 1
+    design = design / scale
+    mu0 = priors[0] * scale
+    precision0 = 1 / (priors[1] * scale) ** 2
+    xtx = design.T @ design
+    xty = design.T @ y
+
+    def evaluate(log_sigma):
+        variance = np.exp(2 * log_sigma)[:, np.newaxis]
+        precision = np.diag(precision0) + xtx / variance[:, :, np.newaxis]
+        means = np.linalg.solve(precision, (precision0 * mu0 + xty / variance)[:, :, np.newaxis])[:, :, 0]
+        residual = y - means @ design.T
+        quadratic = (residual ** 2).sum(axis=1) / variance[:, 0] + ((means - mu0) ** 2 * precision0).sum(axis=1)
+        logdet = np.linalg.slogdet(precision)[1]
+        # Normal likelihood with the coefficients integrated out, HalfNormal prior, jacobian of log sigma
+        logp = (-len(y) * log_sigma - logdet / 2 - quadratic / 2 - variance[:, 0] / (2 * values['sigma0'] ** 2)
+                + log_sigma)
+        return logp, means, precision
+
+    # a wide coarse grid first, then the fine grid over its mass
+    spread = max(np.std(y), float(values['sigma0']), 1.0)
+    coarse = np.linspace(np.log(spread) - 12, np.log(spread) + 3, 300)
+    logp = evaluate(coarse)[0]
+    mass = np.flatnonzero(logp > logp.max() - 40)
+    step = coarse[1] - coarse[0]
+    log_sigma = np.linspace(coarse[mass[0]] - step, coarse[mass[-1]] + step, grid)
+
+    logp, means, precision = evaluate(log_sigma)
+    weights = np.exp(logp - logp.max())
+    weights /= weights.sum()
+
+    # precision = L @ L.T, so the covariance is inv(L).T @ inv(L) - the rows are unscaled last
+    factors = np.linalg.inv(np.linalg.cholesky(precision)).transpose(0, 2, 1) / scale[:, np.newaxis]
+    covs = factors @ factors.transpose(0, 2, 1)
+    means = means / scale
+    mean = weights @ means
+    second = np.einsum('g,gij->ij', weights, covs + means[:, :, np.newaxis] * means[:, np.newaxis, :])
+
+    return {'sigma': np.exp(log_sigma), 'weights': weights, 'means': means, 'covs': covs,
+            'factors': factors, 'mean': mean, 'cov': second - np.outer(mean, mean)}
+
+
+def fit_analytic(x, y, order, draws=1000, random_seed=None, **priors):
+
+    """
+    independent draws from the posterior of a polynomial model, see conjugate_posterior()
+
+    No model is built or compiled and nothing is sampled with MCMC - a fit takes milliseconds.
+
+    :param x: datapoints
+    :param y: data
+    :param order: order of the polynomial 0, 1, 2, ...
+    :param draws: number of draws
+    :param random_seed: seed of the draws
+    :param **priors: intercept, a1, ... aN and sigma0 as in poly_model()
+    :return: dict of variable name: array of shape (1, draws), with "intercept", "a1", ... and "sigma"
+    """
+
+    import numpy as np
+
+    posterior = conjugate_posterior(x, y, order, **priors)
+    rng = np.random.RandomState(random_seed)
+
+    log_sigma = np.log(posterior['sigma'])
+    index = rng.choice(len(log_sigma), size=draws, p=posterior['weights'])
+    # sigma spread evenly over its grid cell
+    sigma = np.exp(log_sigma[index] + (log_sigma[1] - log_sigma[0]) * (rng.random_sample(draws) - 0.5))
+
+    coefficients = posterior['means'][index] + np.einsum('dij,dj->di', posterior['factors'][index],
+                                                         rng.standard_normal((draws, order + 1)))
+
+    names = ['intercept'] + ['a%d' % (oi + 1) for oi in range(order)]
+    trace = {name: coefficients[np.newaxis, :, ni] for ni, name in enumerate(names)}
+    trace['sigma'] = sigma[np.newaxis]
+
+    return trace
+
+
+def fit_advi(model, names, method='advi', draws=1000, iterations=50000, tolerance=1e-3, start=None):
+
+    """
+    variational fit of the model, stopped when the parameters of the approximation converge
+
+    The parameters of the models differ by orders of magnitude in scale, so the fit
+    converges much faster (and to the same mode as the samplers) when it starts from
+    the MAP point, see map_point().
+
+    :param model: pymc3 model
+    :param names: variable names to take
+    :param method: 'advi' for mean-field or 'fullrank_advi' for full-rank ADVI
+    :param draws: number of draws from the approximation
+    :param iterations: maximum number of optimization steps
+    :param tolerance: relative change of the approximation parameters that counts as converged
+    :param start: point to start from, defaults to model.test_point
+    :return: dict of variable name: array of shape (1, draws)
+    """
+
+    import pymc3 as pm
+
+    convergence = pm.callbacks.CheckParametersConvergence(every=100, tolerance=tolerance, diff='relative')
+    approx = pm.fit(iterations, method=method, model=model, start=start, callbacks=[convergence],
+                    progressbar=False)
+
+    return posterior_from_trace(approx.sample(draws), names)
+
+
+def map_functions(model):
+
+    """
+    compiled functions of a model for fit_map()
+
+    :param model: pymc3 model
+    :return: dict with the log density and its gradient (without jacobian terms) and
+             the values of all untransformed variables
+    """
+
+    from pymc3.util import is_transformed_name
+
+    names = [var.name for var in model.unobserved_RVs if not is_transformed_name(var.name)]
+
+    return {'logp': model.fastlogp_nojac,
+            'dlogp': model.fastdlogp_nojac(model.cont_vars),
+            'names': names,
+            'values': model.fastfn([model[name] for name in names])}
+
+
+def gradient_function(model):
+
+    """
+    compiled gradient of the log density for the Laplace approximation of fit_map()
+
+    :param model: pymc3 model
+    :return: function of a point returning the gradient over model.cont_vars
+    """
+
+    return model.fastdlogp(model.cont_vars)
+
+
+def map_point(model, functions):
+
+    """
+    maximum a posteriori point of the model
+
+    :param model: pymc3 model - the optimization starts from model.test_point
+    :param functions: output of map_functions() for the model
+    :return: dict of the free (transformed) variables at the MAP point
+    """
+
+    import scipy.optimize
+    from pymc3.blocking import ArrayOrdering, DictToArrayBijection
+
+    import numpy as np
+
+    start = model.test_point
+    bij = DictToArrayBijection(ArrayOrdering(model.cont_vars), start)
+    logp = bij.mapf(functions['logp'])
+    dlogp = bij.mapf(functions['dlogp'])
+
+    # the parameters differ by orders of magnitude (peak ~1e5, expo ~0.1) - optimize them
+    # relative to the size of their start values to keep the problem well conditioned
+    q0 = bij.map(start)
+    scale = np.maximum(np.abs(q0), 1)
+
+    result = scipy.optimize.minimize(lambda z: -logp(q0 + scale * z), np.zeros(len(q0)),
+                                     jac=lambda z: -dlogp(q0 + scale * z) * scale,
+                                     method='L-BFGS-B')
+
+    return bij.rmap(q0 + scale * result.x)
+
+
+def fit_map(model, functions, gradient=None, draws=1000, random_seed=None):
+
+    """
+    maximum a posteriori point of the model, optionally with a Laplace approximation
+
+    Without a gradient the posterior is the single MAP point. With the gradient the
+    draws come from a normal distribution around the MAP point in the transformed
+    (unbounded) space, with the inverse hessian as covariance. The hessian is taken
+    with central differences of the gradient, which avoids compiling a hessian graph.
+
+    :param model: pymc3 model - the optimization starts from model.test_point
+    :param functions: output of map_functions() for the model
+    :param gradient: output of gradient_function() for the model, or None for the point only
+    :param draws: number of draws from the Laplace approximation
+    :param random_seed: seed of the draws
+    :return: dict of variable name: array of shape (1, draws)
+    """
+
+    import numpy as np
+    from pymc3.blocking import ArrayOrdering, DictToArrayBijection
+
+    point = map_point(model, functions)
+    bij = DictToArrayBijection(ArrayOrdering(model.cont_vars), point)
+    mode = bij.map(point)
+
+    if gradient is None:
+        points = mode[np.newaxis, :]
+    else:
+        cov = np.linalg.pinv(_negative_hessian(bij.mapf(gradient), mode))
+        rng = np.random.RandomState(random_seed)
+        points = rng.multivariate_normal(mode, cov, size=draws, check_valid='ignore')
+
+    values = [functions['values'](bij.rmap(point)) for point in points]
+
+    return {name: np.array([value[ni] for value in values], dtype=float)[np.newaxis]
+            for ni, name in enumerate(functions['names'])}
+
+
+def _negative_hessian(gradient, point):
+
+    import numpy as np
+
+    steps = 1e-5 * np.maximum(np.abs(point), 1)
+    hessian = np.empty((len(point), len(point)))
+    for i, step in enumerate(steps):
+        shift = np.zeros(len(point))
+        shift[i] = step
+        hessian[i] = (gradient(point - shift) - gradient(point + shift)) / (2 * step)
+
+    return (hessian + hessian.T) / 2
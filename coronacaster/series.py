@@ -0,0 +1,270 @@
+WORLD = ('World', 'all', '')
+
+
+class CountrySeriesIndex:
+
+    """
+    per-country time series of the loader output, sorted and accumulated once
+
+    The rows are sorted by country and date so that every country is a contiguous
+    slice of the dates, cases, deaths, cumcases and cumdeaths arrays. The "World"
+    aggregate is summed over all countries per date once at construction.
+
+        index = CountrySeriesIndex(coronacaster.get_data_from_eu())
+        coronacaster.forecast('Finland', index)
+
+    :param data: dataframe with "dates", "countries", "cases" and "deaths" columns
+    """
+
+    def __init__(self, data):
+
+        import numpy as np
+
+        data = data.sort_values(['countries', 'dates'], kind='mergesort')
+
+        countries = data.countries.values.astype(str)
+        self.dates = data.dates.values.astype('datetime64[ns]')
+        self.cases = data.cases.values.astype(float)
+        self.deaths = data.deaths.values.astype(float)
+
+        names, starts = np.unique(countries, return_index=True)
+        stops = np.append(starts[1:], len(countries))
+
+        self.cumcases = np.empty_like(self.cases)
+        self.cumdeaths = np.empty_like(self.deaths)
+        self._slices = {}
+        for name, start, stop in zip(names, starts, stops):
+            self._slices[name] = slice(start, stop)
+            np.cumsum(self.cases[start:stop], out=self.cumcases[start:stop])
+            np.cumsum(self.deaths[start:stop], out=self.cumdeaths[start:stop])
+
+        world = data.groupby('dates', sort=True)[['cases', 'deaths']].sum()
+        self._world = {'dates': world.index.values.astype('datetime64[ns]'),
+                       'cases': world.cases.values.astype(float),
+                       'deaths': world.deaths.values.astype(float)}
+        self._world['cumcases'] = np.cumsum(self._world['cases'])
+        self._world['cumdeaths'] = np.cumsum(self._world['deaths'])
+
+    @property
+    def countries(self):
+
+        return list(self._slices)
+
+    def __len__(self):
+
+        return len(self._slices)
+
+    def __contains__(self, country):
+
+        return country in WORLD or country in self._slices
+
+    def update(self, rows):
+
+        """
+        apply new and corrected rows, e.g. the changes returned by data.update_data()
+
+        Rows of a (country, date) already in the index replace its values, other rows are
+        added. Corrections are written into the arrays in place; new dates and countries
+        make new arrays. Only the cumulative sums of the changed countries are recomputed,
+        and the "World" aggregate is updated by the differences.
+
+        :param rows: dataframe with "dates", "countries", "cases" and "deaths" columns
+        :return: sorted list of the changed countries
+        """
+
+        import numpy as np
+
+        rows = rows.drop_duplicates(['countries', 'dates'], keep='last').sort_values(['countries', 'dates'],
+                                                                                    kind='mergesort')
+        countries = rows.countries.values.astype(str)
+        dates = rows.dates.values.astype('datetime64[ns]')
+        cases = rows.cases.values.astype(float)
+        deaths = rows.deaths.values.astype(float)
+
+        names, starts = np.unique(countries, return_index=True)
+        stops = np.append(starts[1:], len(countries))
+
+        changed = []
+        segments = {}
+        world = []  # (dates, change of cases, change of deaths)
+        for name, start, stop in zip(names, starts, stops):
+            new_dates, new_cases, new_deaths = dates[start:stop], cases[start:stop], deaths[start:stop]
+            part = self._slices.get(name, slice(0, 0))
+            old_dates = self.dates[part]
+
+            position = np.searchsorted(old_dates, new_dates)
+            known = position < len(old_dates)
+            known[known] = old_dates[position[known]] == new_dates[known]
+
+            old_cases = np.zeros(len(new_dates))
+            old_deaths = np.zeros(len(new_dates))
+            old_cases[known] = self.cases[part][position[known]]
+            old_deaths[known] = self.deaths[part][position[known]]
+            differs = (old_cases != new_cases) | (old_deaths != new_deaths)
+            if not differs.any():
+                continue
+
+            changed.append(name)
+            world.append((new_dates[differs], (new_cases - old_cases)[differs], (new_deaths - old_deaths)[differs]))
+
+            if known.all():
+                # corrections only - in place
+                self.cases[part][position] = new_cases
+                self.deaths[part][position] = new_deaths
+                np.cumsum(self.cases[part], out=self.cumcases[part])
+                np.cumsum(self.deaths[part], out=self.cumdeaths[part])
+            else:
+                segment = {'dates': old_dates.copy(), 'cases': self.cases[part].copy(),
+                           'deaths': self.deaths[part].copy()}
+                segment['cases'][position[known]] = new_cases[known]
+                segment['deaths'][position[known]] = new_deaths[known]
+                for key, values in (('dates', new_dates), ('cases', new_cases), ('deaths', new_deaths)):
+                    segment[key] = np.insert(segment[key], position[~known], values[~known])
+                segments[name] = segment
+
+        if segments:
+            self._rebuild(segments)
+
+        if world:
+            self._update_world(*[np.concatenate(values) for values in zip(*world)])
+
+        return changed
+
+    def _rebuild(self, segments):
+
+        import numpy as np
+
+        parts = {'dates': [], 'cases': [], 'deaths': [], 'cumcases': [], 'cumdeaths': []}
+        slices = {}
+        position = 0
+        for name in sorted(set(self._slices) | set(segments)):
+            if name in segments:
+                segment = dict(segments[name], cumcases=np.cumsum(segments[name]['cases']),
+                               cumdeaths=np.cumsum(segments[name]['deaths']))
+            else:
+                segment = self.get(name)
+            for key in parts:
+                parts[key].append(segment[key])
+            slices[name] = slice(position, position + len(segment['dates']))
+            position += len(segment['dates'])
+
+        for key, values in parts.items():
+            setattr(self, key, np.concatenate(values))
+        self._slices = slices
+
+    def _update_world(self, dates, cases, deaths):
+
+        import numpy as np
+
+        world = self._world
+        merged = np.union1d(world['dates'], dates)
+        if len(merged) > len(world['dates']):
+            position = np.searchsorted(merged, world['dates'])
+            for key in ('cases', 'deaths'):
+                values = np.zeros(len(merged))
+                values[position] = world[key]
+                world[key] = values
+            world['dates'] = merged
+
+        position = np.searchsorted(world['dates'], dates)
+        np.add.at(world['cases'], position, cases)
+        np.add.at(world['deaths'], position, deaths)
+        world['cumcases'] = np.cumsum(world['cases'])
+        world['cumdeaths'] = np.cumsum(world['deaths'])
+
+    def get(self, country):
+
+        """
+        arrays of one country as a dict of dates, cases, deaths, cumcases and cumdeaths
+
+        :param country: country name, or "World", "all" or "" for the aggregate of all countries
+        :return: dict of NumPy arrays (views, don't modify them)
+        """
+
+        if country in WORLD:
+            return self._world
+
+        try:
+            part = self._slices[country]
+        except KeyError:
+            raise KeyError('no data for country %r' % country) from None
+
+        return {'dates': self.dates[part],
+                'cases': self.cases[part],
+                'deaths': self.deaths[part],
+                'cumcases': self.cumcases[part],
+                'cumdeaths': self.cumdeaths[part]}
+
+    def frame(self, country):
+
+        """
+        series of one country as a new dataframe sorted by date
+
+        :param country: country name, or "World", "all" or "" for the aggregate of all countries
+        :return: dataframe with "dates", "cases", "deaths", "cumcases" and "cumdeaths" columns
+        """
+
+        import pandas as pd
+
+        return pd.DataFrame(self.get(country))
+
+
+def country_arrays(country, data):
+
+    """
+    daily and cumulative series of one country as NumPy arrays sorted by date
+
+    With a dataframe only the rows of the country are taken, or the "World" aggregate
+    is summed per date with one groupby - the dataframe is not modified.
+
+    :param country: country name, or "World", "all" or "" for the aggregate of all countries
+    :param data: dataframe with "dates", "countries", "cases" and "deaths" columns, or a CountrySeriesIndex
+    :return: dict of dates, cases, deaths, cumcases and cumdeaths arrays as in CountrySeriesIndex.get()
+    """
+
+    import numpy as np
+
+    if isinstance(data, CountrySeriesIndex):
+        return data.get(country)
+
+    if country in WORLD:
+        summed = data.groupby('dates', sort=True)[['cases', 'deaths']].sum()
+        dates = summed.index.values
+        cases = summed.cases.values
+        deaths = summed.deaths.values
+    else:
+        rows = (data.countries == country).values
+        if not rows.any():
+            raise KeyError('no data for country %r' % country)
+        dates = data.dates.values[rows]
+        order = np.argsort(dates, kind='mergesort')
+        dates = dates[order]
+        cases = data.cases.values[rows][order]
+        deaths = data.deaths.values[rows][order]
+
+    cases = cases.astype(float)
+    deaths = deaths.astype(float)
+
+    return {'dates': dates.astype('datetime64[ns]'),
+            'cases': cases,
+            'deaths': deaths,
+            'cumcases': np.cumsum(cases),
+            'cumdeaths': np.cumsum(deaths)}
+
+
+def first_over(cumulative, limit=0):
+
+    """
+    position of the first value over a limit, found with a binary search
+
+    Corrections can make a cumulative series decrease, so the search is made on its
+    running maximum - which is first over the limit at the same position.
+
+    :param cumulative: array of cumulative counts
+    :param limit: limit
+    :return: position, or len(cumulative) if no value is over the limit
+    """
+
+    import numpy as np
+
+    return int(np.searchsorted(np.maximum.accumulate(cumulative), limit, side='right'))
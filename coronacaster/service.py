@@ -0,0 +1,487 @@
+# set by the service itself, or not expressible in json
+RESERVED_PARAMS = {'data', 'plot', 'cache', 'cache_dir', 'cpu_cores', 'profile', 'profile_hook', 'return_inis',
+                   'previous'}
+
+
+def serve(data, host='127.0.0.1', port=8150, workers=2, cpu_cores=4, warm=('poly1',), cache_dir=None):
+
+    """
+    run the forecast service until interrupted
+
+    A local HTTP/JSON service around forecast() and plot_country():
+
+        POST /forecast   {"country": "Finland", "ftype": "poly2", "wait": 10, ...forecast() parameters}
+        GET  /jobs       all jobs
+        GET  /jobs/<id>  status and result of a job, ?wait=10 waits up to 10 seconds for it to finish
+        POST /plot       {"country": "Finland", "log": "log", ...plot_country() parameters} - returns a png
+        GET  /health
+
+    A forecast with a stored result (see cache.py) is answered at once. Otherwise it becomes
+    a job that is fitted in a pool of worker processes, which keep their compiled models
+    between the jobs. An identical request while the job is queued or running gets the same
+    job instead of a second fit. See ServiceClient for a client.
+
+    :param data: dataframe as in forecast() or a CountrySeriesIndex
+    :param host: address to listen on
+    :param port: port to listen on
+    :param workers: number of fits at the same time
+    :param cpu_cores: total number of cores of the fits, see batch.budget_cores()
+    :param warm: model types each worker compiles when it starts
+    :param cache_dir: directory of the result cache as in forecast()
+    """
+
+    import asyncio
+
+    service = ForecastService(data, workers=workers, cpu_cores=cpu_cores, warm=warm, cache_dir=cache_dir)
+    try:
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+class ForecastService:
+
+    """
+    jobs, request coalescing and the worker pool of serve()
+
+    :param data: dataframe as in forecast() or a CountrySeriesIndex
+    :param workers: number of fits at the same time
+    :param cpu_cores: total number of cores of the fits
+    :param warm: model types each worker compiles when it starts
+    :param cache_dir: directory of the result cache as in forecast()
+    :param keep: number of finished jobs kept for status requests
+    """
+
+    def __init__(self, data, workers=2, cpu_cores=4, warm=(), cache_dir=None, keep=1000):
+
+        import collections
+        import concurrent.futures
+
+        from .batch import budget_cores
+        from .series import CountrySeriesIndex
+
+        if not isinstance(data, CountrySeriesIndex):
+            data = CountrySeriesIndex(data)
+
+        self.data = data
+        self.workers, self.cores_per_fit = budget_cores(workers, cpu_cores, workers)
+        self.cache_dir = cache_dir
+        self.keep = keep
+        self.jobs = collections.OrderedDict()
+
+        self._pending = {}  # request key: job or plot future, while it is not finished
+        self._submitted = set()  # pool futures, cancelled on close
+        self._slots = None
+        self._pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=_init_service_worker,
+                                                            initargs=(data, tuple(warm)))
+
+    async def serve(self, host='127.0.0.1', port=8150):
+
+        import asyncio
+
+        server = await asyncio.start_server(self._handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+
+        # shutdown(cancel_futures=True) needs python 3.9
+        for future in list(self._submitted):
+            future.cancel()
+        self._pool.shutdown(wait=False)
+
+    async def forecast(self, params, wait=0):
+
+        """
+        the stored result of a forecast, or its job
+
+        :param params: forecast() parameters - dates as 'YYYY-MM-DD'
+        :param wait: seconds to wait for the job to finish
+        :return: job dict as in job()
+        """
+
+        import json
+        import asyncio
+
+        params = _fit_params(params, self.cache_dir)
+        key = 'forecast ' + json.dumps(params, sort_keys=True, default=str)
+
+        if key not in self._pending:
+            loop = asyncio.get_running_loop()
+            df = await loop.run_in_executor(None, _stored_result, self.data, params)
+            if df is not None:
+                return {'status': 'done', 'cached': True, 'country': params['country'],
+                        'ftype': params.get('ftype', 'poly1'), 'result': _result_dict(df)}
+
+        # another request may have started the same job during the lookup
+        if key not in self._pending:
+            self._start(key, params)
+
+        job = self._pending[key]
+        if wait:
+            await asyncio.wait({job['future']}, timeout=wait)
+
+        return self.job(job['id'])
+
+    def job(self, job_id):
+
+        """
+        status of a job
+
+        :param job_id: job id
+        :return: dict of "id", "status" ('queued', 'running', 'done' or 'failed'), "country", "ftype",
+                 "elapsed" seconds and the "result" or "error" when finished
+        """
+
+        import time
+
+        job = self.jobs[job_id]
+        view = {key: value for key, value in job.items() if key not in ('future', 'params')}
+        view['elapsed'] = (job['finished'] or time.time()) - job['submitted']
+
+        return view
+
+    async def plot(self, params):
+
+        """
+        plot_country() as png
+
+        :param params: plot_country() parameters
+        :return: png bytes, or None if the country has no cases over the limit
+        """
+
+        import json
+        import asyncio
+
+        key = 'plot ' + json.dumps(params, sort_keys=True, default=str)
+        if key not in self._pending:
+            future = self._submit(_plot_png, params)
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+            self._pending[key] = future
+
+        return await asyncio.shield(self._pending[key])
+
+    def _submit(self, function, *args):
+
+        import asyncio
+
+        future = self._pool.submit(function, *args)
+        self._submitted.add(future)
+        future.add_done_callback(self._submitted.discard)
+
+        return asyncio.wrap_future(future)
+
+    def _start(self, key, params):
+
+        import time
+        import uuid
+        import asyncio
+
+        job = {'id': uuid.uuid4().hex[:12], 'status': 'queued', 'country': params['country'],
+               'ftype': params.get('ftype', 'poly1'), 'submitted': time.time(), 'started': None,
+               'finished': None, 'result': None, 'error': None, 'params': params}
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        job['future'] = asyncio.ensure_future(self._run(key, job))
+
+        self.jobs[job['id']] = job
+        self._pending[key] = job
+
+        # forget the oldest finished jobs
+        finished = [job_id for job_id, old in self.jobs.items() if old['finished'] is not None]
+        for job_id in finished[:max(0, len(self.jobs) - self.keep)]:
+            del self.jobs[job_id]
+
+        return job
+
+    async def _run(self, key, job):
+
+        import time
+
+        from .batch import _run_task
+
+        try:
+            async with self._slots:
+                job.update(status='running', started=time.time())
+                df, error = await self._submit(_run_task, job['params'], self.cores_per_fit)
+        except Exception as e:
+            # the worker process itself died, e.g. out of memory
+            df, error = None, '%s: %s' % (type(e).__name__, e)
+        finally:
+            self._pending.pop(key, None)
+
+        job.update(status='failed' if df is None else 'done', finished=time.time(), error=error,
+                   result=None if df is None else _result_dict(df))
+
+    async def _handle(self, reader, writer):
+
+        import json
+
+        try:
+            method, path, query, body = await _read_request(reader)
+            status, content_type, payload = await self._route(method, path, query, body)
+        except (ValueError, KeyError) as e:
+            status, content_type, payload = 400, 'application/json', {'error': '%s: %s' % (type(e).__name__, e)}
+        except Exception as e:
+            status, content_type, payload = 500, 'application/json', {'error': '%s: %s' % (type(e).__name__, e)}
+
+        if content_type == 'application/json':
+            payload = json.dumps(payload).encode()
+
+        reason = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                      % (status, reason.get(status, ''), content_type, len(payload))).encode() + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, query, body):
+
+        import json
+
+        parts = path.strip('/').split('/')
+
+        if method == 'GET' and parts == ['health']:
+            statuses = [job['status'] for job in self.jobs.values()]
+            return 200, 'application/json', {'status': 'ok', 'workers': self.workers,
+                                             'jobs': {status: statuses.count(status) for status in set(statuses)}}
+
+        if method == 'POST' and parts == ['forecast']:
+            params = json.loads(body or b'{}')
+            job = await self.forecast(params, wait=float(params.pop('wait', 0) or 0))
+            return 200 if job['status'] in ('done', 'failed') else 202, 'application/json', job
+
+        if method == 'GET' and parts == ['jobs']:
+            return 200, 'application/json', [self.job(job_id) for job_id in self.jobs]
+
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'jobs':
+            if parts[1] not in self.jobs:
+                return 404, 'application/json', {'error': 'no job %r' % parts[1]}
+            wait = float(query.get('wait', 0))
+            if wait and self.jobs[parts[1]]['finished'] is None:
+                import asyncio
+                await asyncio.wait({self.jobs[parts[1]]['future']}, timeout=wait)
+            job = self.job(parts[1])
+            return 200 if job['status'] in ('done', 'failed') else 202, 'application/json', job
+
+        if method == 'POST' and parts == ['plot']:
+            png = await self.plot(json.loads(body or b'{}'))
+            if png is None:
+                return 404, 'application/json', {'error': 'no cases to plot'}
+            return 200, 'image/png', png
+
+        return 404, 'application/json', {'error': 'no route %s %s' % (method, path)}
+
+
+class ServiceClient:
+
+    """
+    client of a running serve()
+
+        client = coronacaster.ServiceClient()
+        client.result('Finland', ftype='poly2', targetdate='2020-06-30')
+
+    :param url: address of the service
+    :param timeout: seconds to wait for a response
+    """
+
+    def __init__(self, url='http://127.0.0.1:8150', timeout=600):
+
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def forecast(self, country, wait=0, **params):
+
+        """
+        submit a forecast
+
+        :param country: country name
+        :param wait: seconds the service waits for the fit to finish before answering
+        :param **params: forecast() parameters, dates as datetime.date or 'YYYY-MM-DD'
+        :return: job dict, see ForecastService.job()
+        """
+
+        return self._request('/forecast', dict(params, country=country, wait=wait))
+
+    def job(self, job_id, wait=0):
+
+        """
+        :param job_id: id of a job from forecast()
+        :param wait: seconds the service waits for the job to finish before answering
+        :return: job dict, see ForecastService.job()
+        """
+
+        return self._request('/jobs/%s?wait=%g' % (job_id, wait))
+
+    def result(self, country, poll=30, timeout=None, **params):
+
+        """
+        forecast and wait for its result
+
+        :param country: country name
+        :param poll: seconds per status request
+        :param timeout: seconds to wait at most, None for no limit
+        :param **params: forecast() parameters
+        :return: result series as the first column of forecast()
+        """
+
+        import time
+        import pandas as pd
+
+        start = time.time()
+        job = self.forecast(country, wait=poll, **params)
+        while job['status'] in ('queued', 'running'):
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError('job %s of %s still %s' % (job['id'], country, job['status']))
+            job = self.job(job['id'], wait=poll)
+
+        if job['status'] == 'failed':
+            raise RuntimeError('forecast of %s failed: %s' % (country, job['error']))
+
+        return pd.Series(job['result'], name=country)
+
+    def plot(self, country, path=None, **params):
+
+        """
+        plot_country() of the service as png
+
+        :param country: country name
+        :param path: file to write the png to
+        :param **params: plot_country() parameters
+        :return: png bytes
+        """
+
+        png = self._request('/plot', dict(params, country=country))
+        if path is not None:
+            with open(path, 'wb') as f:
+                f.write(png)
+
+        return png
+
+    def health(self):
+
+        return self._request('/health')
+
+    def _request(self, path, params=None):
+
+        import json
+        import urllib.error
+        import urllib.request
+
+        body = None if params is None else json.dumps(params, default=str).encode()
+        request = urllib.request.Request(self.url + path, data=body, method='GET' if body is None else 'POST',
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                content = response.read()
+                kind = response.headers.get('Content-Type')
+        except urllib.error.HTTPError as e:
+            raise RuntimeError('%s %s: %s' % (e.code, path, e.read().decode(errors='replace'))) from None
+
+        return json.loads(content) if kind == 'application/json' else content
+
+
+async def _read_request(reader):
+
+    import urllib.parse
+
+    line = (await reader.readline()).decode('latin-1')
+    method, target = line.split()[:2]
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    url = urllib.parse.urlsplit(target)
+
+    return method, url.path, dict(urllib.parse.parse_qsl(url.query)), body
+
+
+def _fit_params(params, cache_dir):
+
+    import pandas as pd
+
+    params = dict(params)
+    if 'country' not in params:
+        raise ValueError('a forecast needs a country')
+
+    reserved = set(params) & RESERVED_PARAMS
+    if reserved:
+        raise ValueError('%s cannot be set in a request' % ', '.join(sorted(reserved)))
+
+    for name in ('startdate', 'enddate', 'targetdate'):
+        if params.get(name) is not None:
+            params[name] = pd.Timestamp(params[name]).date()
+    if 'quantiles' in params:
+        params['quantiles'] = tuple(params['quantiles'])
+
+    # results go to the result cache, so that the next identical request is answered from it
+    params.update(plot=False, cache=True, cache_dir=cache_dir)
+
+    return params
+
+
+def _stored_result(data, params):
+
+    from .forecast import forecast
+
+    return forecast(data=data, **dict(params, cache='only'))
+
+
+def _result_dict(df):
+
+    return {str(name): float(value) for name, value in df.iloc[:, 0].items()}
+
+
+def _init_service_worker(data, warm):
+
+    from .batch import _init_worker
+
+    _init_worker(data)
+
+    # compile the models of the warm types with the world data - later fits only swap the data
+    if warm:
+        import pymc3 as pm
+        from .forecast import forecast, _window
+        from .models import cached_model, cached_step
+
+        for ftype in warm:
+            # only a head start - a model that cannot be warmed is compiled by its first fit
+            try:
+                _, _, _, _, x, y = _window('World', data)
+                priors = forecast('World', data, ftype=ftype, return_inis=True)
+                if priors is not None:
+                    cached_model(ftype, x, y, **priors)
+                    cached_step(ftype, pm.Slice)
+            except Exception:
+                pass
+
+
+def _plot_png(params):
+
+    import io
+    import matplotlib.pyplot as plt
+
+    from .plots import plot_country
+    from .batch import _worker_data
+
+    params = dict(params)
+    country = params.pop('country')
+
+    try:
+        if plot_country(country, _worker_data, **params) is None:
+            return None
+        buffer = io.BytesIO()
+        plt.gcf().savefig(buffer, format='png')
+    finally:
+        plt.close('all')
+
+    return buffer.getvalue()
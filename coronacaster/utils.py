@@ -7,29 +7,89 @@ def calculateStats(DataSeries, mode=None):
     """
 
     import numpy as np
-    import datetime
 
     if mode == 'cols':
         return 'min','max','mean','stddev','10%-percentile','20%percentile','median','80%percentile','90%percentile'
 
-    data = np.array(DataSeries).astype(np.float)
-    output = np.empty(9)
-    output[0] = data.min()
-    output[1] = data.max()
-    output[2] = np.nanmean(data)
-    output[3] = np.nanstd(data)
-    output[4] = np.nanpercentile(data, 10)
-    output[5] = np.nanpercentile(data, 20)
-    output[6] = np.nanpercentile(data, 50)
-    output[7] = np.nanpercentile(data, 80)
-    output[8] = np.nanpercentile(data, 90)
-    
+    return summary_stats(np.array(DataSeries, dtype=float).reshape(1, -1))[0]
+
+
+def summary_stats(values):
+    """
+    calculateStats() of many variables in one pass, ignores nan's
+    :param values: array of shape (variables, draws)
+    :return: array of shape (variables, 9) with the columns of calculateStats()
+    """
+
+    import numpy as np
+
+    output = np.empty((len(values), 9))
+    output[:, 0] = np.nanmin(values, axis=1)
+    output[:, 1] = np.nanmax(values, axis=1)
+    output[:, 2] = np.nanmean(values, axis=1)
+    output[:, 3] = np.nanstd(values, axis=1)
+    output[:, 4:] = np.nanquantile(values, [0.1, 0.2, 0.5, 0.8, 0.9], axis=1).T
+
     return output
 
 
+# id of an array of draws: (weak reference to it, its calculateStats() vector)
+_stats_memo = {}
+
+
+def trace_stats(trace, varnames, chunk=None):
+    """
+    calculateStats() of all variables of a posterior at once
+    The statistics are kept per array of draws for as long as the array exists, so a posterior
+    is summarized only once - its draws must not be changed in place after the first call.
+    :param trace: dict of variable name: array of draws, e.g. of shape (chains, draws)
+    :param varnames: variable names
+    :param chunk: number of variables read into memory at a time, e.g. 1 for memory mapped draws - None for all
+    :return: dict of variable name: 9-length vector as in calculateStats()
+    """
+
+    import numpy as np
+
+    stats = {va: _memo_stats(trace[va]) for va in varnames}
+    missing = [va for va, row in stats.items() if row is None]
+    chunk = chunk or len(missing)
+    for start in range(0, len(missing), chunk):
+        names = missing[start:start + chunk]
+        values = summary_stats(np.stack([np.ravel(trace[va]) for va in names]).astype(float))
+        for va, row in zip(names, values):
+            stats[va] = row
+            _store_stats(trace[va], row)
+
+    return stats
+
+
+def _memo_stats(draws):
+
+    entry = _stats_memo.get(id(draws))
+    if entry is None or entry[0]() is not draws:
+        return None
+
+    return entry[1]
+
+
+def _store_stats(draws, row):
+
+    import weakref
+
+    key = id(draws)
+    try:
+        # the entry goes with the array, so its id cannot be reused for other draws
+        reference = weakref.ref(draws, lambda _: _stats_memo.pop(key, None))
+    except TypeError:
+        # e.g. a list of draws - not kept
+        return
+
+    _stats_memo[key] = (reference, row)
+
+
 def modelfit_eval_dates(data, x, dates, modelfun, varstats, varnames=[], target=None, sigma=None, plotstrs=None, log='lin'):
     """
-    evaluates the goodness of the model fit to the data
+    evaluates the goodness of the model fit to the data and plots it
     -- need a predition option or separate function
     :param data: data to compare data to
     :param x: data points
@@ -43,14 +103,28 @@ def modelfit_eval_dates(data, x, dates, modelfun, varstats, varnames=[], target=
     :return:
     """
 
+    df, fit = modelfit_eval(data, x, modelfun, varstats, varnames=varnames, target=target, sigma=sigma)
+    plot_modelfit(data, dates, fit, varnames=varnames, sigma=sigma, plotstrs=plotstrs, log=log)
+
+    return df
+
+
+def modelfit_eval(data, x, modelfun, varstats, varnames=[], target=None, sigma=None):
+    """
+    goodness of the model fit, the target prediction and its CI - no plotting
+    :param data: data to compare data to
+    :param x: data points
+    :param modelfun: function of the model of (params[0:N], data)
+    :param varstats: variable stats of 2,3,5,7 from Pandas_utilities.calculateStats(), namely mean, std, 20% and 80%
+    :param varnames: variable names
+    :param target: x value for a preditiction point
+    :param sigma: one variation from mean value fit
+    :return: dataframe of the metrics, dict of the fitted curves for plot_modelfit()
+    """
+
     import numpy as np
     import pandas as pd
 
-    import datetime
-    import matplotlib.pyplot as plt
-    import matplotlib.ticker as ticker
-    import seaborn as sns
-
     x = np.asarray(x)
     data = np.asarray(data)
 
@@ -63,10 +137,10 @@ def modelfit_eval_dates(data, x, dates, modelfun, varstats, varnames=[], target=
 
     datalen = len(data)
     difference = modelmean - data
-    meandiff = sum(np.abs(difference))/datalen
+    meandiff = np.sum(np.abs(difference))/datalen
     L2norm = np.linalg.norm(difference)
-    maxposdifference = max(0, max(difference))
-    maxnegdifference = min(0, min(difference))
+    maxposdifference = max(0, np.max(difference))
+    maxnegdifference = min(0, np.min(difference))
 
     idx = ['corr', 'mean_diff', 'norm_of_diff', 'max_pos_diff', 'max_neg_diff']
     metrics = [corr, meandiff, L2norm, maxposdifference, maxnegdifference]
@@ -74,18 +148,12 @@ def modelfit_eval_dates(data, x, dates, modelfun, varstats, varnames=[], target=
     for ii, ind2 in enumerate(idx):
         df.loc[ind2]=metrics[ii]
 
-    # plot
-    fig = plt.figure(figsize=[12, 8])  #
-    ax1 = fig.add_subplot(111)  # category percentage
-
-    ax1.plot_date(dates, data, 'k^-', linewidth=1.5, markersize=4, label='truth', color='#005082', alpha=.5)
+    fit = {'x': x, 'extended': False, 'target': target, 'target_fit': None, 'yerr': None, 'bands': []}
 
     # target
     pred=0
     if not (target == None):
-        targetdate = min(dates) + datetime.timedelta(days=target)
-        if targetdate>max(dates): #a prediction
-            dates=pd.date_range(start=min(dates),end=targetdate+datetime.timedelta(days=1))
+        if target > x.max() - x.min(): #a prediction (target date after the last date)
             x = np.arange(0,target+2)
             modelmean=modelfun(param_means, x)
             fitTarget = modelfun(param_means, target)
@@ -94,19 +162,11 @@ def modelfit_eval_dates(data, x, dates, modelfun, varstats, varnames=[], target=
         else: # targetdate is where data exists
             fitTarget = modelfun(param_means, target)
             df.loc['target_fit']=fitTarget
-    ax1.plot_date(dates, modelmean, 'bo-', linewidth=1, markersize=4, label='best fit', color='#FF1053', alpha=.5)
-    
-    if not('lin' in log):
-        plt.yscale(log)
-
-    if not (sigma==None):
-        ax1.fill_between(dates, modelmean - sigma, modelmean + sigma, facecolor='#00a8cc', alpha=0.2, label='+/- sigma')
+        fit.update(x=x, extended=bool(pred), target_fit=fitTarget)
+    fit['mean'] = modelmean
 
     # additional CI's:
     if len(varnames) > 0:
-        facecols = ['#ffa41b', '#333333', '#666666', '#999999', '#CCCCCC', '#EEEEEE']
-        facecols = facecols[:len(varnames)]
-        #facecols.reverse()
         err_low=[]
         err_upp=[]
         for vi in range(len(varstats)):
@@ -119,8 +179,7 @@ def modelfit_eval_dates(data, x, dates, modelfun, varstats, varnames=[], target=
                 err_low.append(fitTarget-modelfun(means_temp,target))
             means_temp[vi] = vi_var[1]
             fit2 = modelfun(means_temp, x)
-            ax1.fill_between(dates, fit1, fit2, alpha=0.2, facecolor=facecols[vi % 8],
-                     label='var %s variance' % varnames[vi])
+            fit['bands'].append((fit1, fit2))
             if not (target == None):
                 err_upp.append(modelfun(means_temp,target)-fitTarget)
 
@@ -134,6 +193,7 @@ def modelfit_eval_dates(data, x, dates, modelfun, varstats, varnames=[], target=
             err_upp=err_upp[1:]
             yerr= np.array([np.prod(err_low)**(1/len(err_low)),np.prod(err_upp)**(1/len(err_upp))])
             yerr.shape = (-1, 1)
+            fit['yerr'] = yerr
             if pred:
                 df.loc['prediction_CI_low'] = yerr[0]
                 df.loc['prediction_CI_high'] = yerr[1]
@@ -144,11 +204,67 @@ def modelfit_eval_dates(data, x, dates, modelfun, varstats, varnames=[], target=
         modelmax = modelfun(param_80, x)
         param_20 = np.asarray([par[2] for par in varstats])
         modelmin = modelfun(param_20, x)
+        fit['bands'].append((modelmin, modelmax))
+
+    return df, fit
+
 
+def plot_modelfit(data, dates, fit, varnames=[], sigma=None, plotstrs=None, log='lin'):
+    """
+    plots the data and the model fit of modelfit_eval()
+    :param data: data the model was fitted to
+    :param dates:  data points as datetime.date values
+    :param fit: fitted curves from modelfit_eval() - with a "band" entry of (low, high, label) from
+                predictive_bands() that band is drawn instead of the per variable bands
+    :param varnames: variable names - one band per variable, else one band of all parameter variance
+    :param sigma: one variation from mean value fit
+    :param plotstrs: plotting strings as a list of title, xlabel, ylabel
+    :param log: 'lin' or the y scale, e.g. 'log'
+    :return: the figure
+    """
+
+    import pandas as pd
+
+    import datetime
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+    import seaborn as sns
+
+    fig = plt.figure(figsize=[12, 8])  #
+    ax1 = fig.add_subplot(111)  # category percentage
+
+    ax1.plot_date(dates, data, 'k^-', linewidth=1.5, markersize=4, label='truth', color='#005082', alpha=.5)
+
+    target = fit['target']
+    if not (target == None):
+        targetdate = min(dates) + datetime.timedelta(days=target)
+    if fit['extended']:
+        dates=pd.date_range(start=min(dates),end=targetdate+datetime.timedelta(days=1))
+
+    modelmean = fit['mean']
+    ax1.plot_date(dates, modelmean, 'bo-', linewidth=1, markersize=4, label='best fit', color='#FF1053', alpha=.5)
+
+    if not('lin' in log):
+        plt.yscale(log)
+
+    if not (sigma==None):
+        ax1.fill_between(dates, modelmean - sigma, modelmean + sigma, facecolor='#00a8cc', alpha=0.2, label='+/- sigma')
+
+    if fit.get('band') is not None:
+        low, high, label = fit['band']
+        ax1.fill_between(dates, low, high, alpha=0.3, facecolor='#ffa41b', label=label)
+    elif len(varnames) > 0:
+        facecols = ['#ffa41b', '#333333', '#666666', '#999999', '#CCCCCC', '#EEEEEE']
+        facecols = facecols[:len(varnames)]
+        for vi, (fit1, fit2) in enumerate(fit['bands']):
+            ax1.fill_between(dates, fit1, fit2, alpha=0.2, facecolor=facecols[vi % 8],
+                     label='var %s variance' % varnames[vi])
+    else:
+        modelmin, modelmax = fit['bands'][0]
         ax1.fill_between(dates, modelmin, modelmax, alpha=0.5, facecolor='grey', label='all parameter variance')
 
     if not(target==None):
-        ax1.errorbar(targetdate, fitTarget, yerr=yerr, fmt='ko', ecolor='k', capthick=0, elinewidth=2, label='prediction')
+        ax1.errorbar(targetdate, fit['target_fit'], yerr=fit['yerr'], fmt='ko', ecolor='k', capthick=0, elinewidth=2, label='prediction')
 
     ax1.legend()
     if not (plotstrs == None):
@@ -168,18 +284,97 @@ def modelfit_eval_dates(data, x, dates, modelfun, varstats, varnames=[], target=
 
     sns.despine()
 
-    return df
+    return fig
+
+
+def predictive_bands(modelfun, posterior, varnames, x, quantiles=(0.1, 0.9), noise=None, draws=None,
+                     chunk=100, random_seed=None):
+    """
+    quantiles of the model curve over the joint posterior, all draws evaluated at once
+    :param modelfun: function of the model of (params[0:N], data) - must broadcast over the draws
+    :param posterior: dict of variable name: array of draws, e.g. of shape (chains, draws)
+    :param varnames: variable names in the order of modelfun parameters
+    :param x: data points to evaluate
+    :param quantiles: quantiles of the bands
+    :param noise: name of the normal noise variable, e.g. 'sigma', for the posterior predictive - None for the curve only.
+                  With a single draw, e.g. the MAP point, the quantiles of the noise are exact instead of sampled
+    :param draws: use at most this many draws, evenly thinned
+    :param chunk: number of data points evaluated together - bounds the memory to draws * chunk
+    :param random_seed: seed of the noise
+    :return: array of shape (len(quantiles), len(x))
+    """
+
+    import numpy as np
+    from scipy.special import ndtri
+
+    names = list(varnames) + ([noise] if noise is not None else [])
+    size = np.size(posterior[names[0]])
+    step = int(np.ceil(size / draws)) if draws is not None and size > draws else 1
+    # thinned before the copy - only the used draws of memory mapped traces are read
+    params = np.stack([np.ravel(posterior[name])[::step] for name in names]).astype(float)
+
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    rng = np.random.RandomState(random_seed)
+
+    bands = np.empty((len(quantiles), len(x)))
+    for start in range(0, len(x), chunk):
+        part = slice(start, start + chunk)
+        # (vars, draws, 1) parameters against (1, points) data: one curve per draw
+        curves = modelfun(params[:len(varnames), :, np.newaxis], x[np.newaxis, part])
+        if noise is not None and params.shape[1] == 1:
+            # normal around the one curve
+            bands[:, part] = curves[0] + params[-1, 0] * ndtri(np.asarray(quantiles, dtype=float))[:, np.newaxis]
+            continue
+        if noise is not None:
+            curves = curves + params[-1][:, np.newaxis] * rng.standard_normal(curves.shape)
+        bands[:, part] = np.quantile(curves, quantiles, axis=0)
+
+    return bands
 
 
 def poly_fun(x, y):
     """
-    function x[0] + x[1]*y + x[2]*y**2 + ...
+    function x[0] + x[1]*y + x[2]*y**2 + ... evaluated with Horner's scheme
+    The parameters and the datapoints broadcast, so e.g. parameters of shape (N, draws, 1)
+    and datapoints of shape (points,) give all curves of shape (draws, points) at once.
     :param x: parameters
     :param y: datapoints
 #    :param order: polynomial order  - we get this from the length of x
     :return: result
     """
-    ret = 0
-    for oi in range(len(x)):
-        ret += x[oi] * y **oi
-    return ret
\ No newline at end of file
+
+    import numpy as np
+
+    y = np.asarray(y, dtype=float)
+    ret = np.empty(np.broadcast(y, *x).shape)
+    ret[...] = x[-1]
+    for coefficient in x[-2::-1]:
+        ret *= y
+        ret += coefficient
+    return ret[()]
+
+
+def exp_fun(x, y):
+    """
+    function x[0] + x[1]*exp(x[2]*y) of the exponential model, broadcasts as poly_fun()
+    :param x: parameters intercept, slope and expo
+    :param y: datapoints
+    :return: result
+    """
+
+    import numpy as np
+
+    return x[0] + x[1] * np.exp(x[2] * y)
+
+
+def logistic_fun(x, y):
+    """
+    function x[0] + x[1]/(1 + exp(-x[2]*(y - x[3]))) of the logistic model, broadcasts as poly_fun()
+    :param x: parameters intercept, peak, expo and shifted
+    :param y: datapoints
+    :return: result
+    """
+
+    import numpy as np
+
+    return x[0] + x[1] / (1 + np.exp(-x[2] * y + x[2] * x[3]))
@@ -25,7 +25,8 @@ install_requires = ['pymc3',
                     'seaborn',
                     'pandas',
                     'numpy',
-                    'xlrd']
+                    'xlrd',
+                    'pyarrow']
 
 if __name__ == "__main__":
 
@@ -42,6 +43,7 @@ if __name__ == "__main__":
           download_url=DOWNLOAD_URL,
           install_requires=install_requires,
           packages=['coronacaster'],
+          entry_points={'console_scripts': ['coronacaster = coronacaster.cli:main']},
 
           classifiers=['Intended Audience :: Science/Research',
                        'Programming Language :: Python :: 3.6',
@@ -1,7 +1,94 @@
+import subprocess
+import sys
+
+# importing the package must stay cheap - pymc3, theano and matplotlib load only when a fit or a plot needs them
+check = ('import sys, time; t = time.time(); import coronacaster; print(time.time() - t); '
+         'print([name for name in ("pymc3", "theano", "matplotlib", "seaborn", "pandas") if name in sys.modules])')
+seconds, loaded = subprocess.check_output([sys.executable, '-c', check], text=True).splitlines()
+assert float(seconds) < 0.5, 'import coronacaster took %s s' % seconds
+assert loaded == '[]', 'import coronacaster loaded %s' % loaded
+
+import os
+import json
+import tempfile
+import numpy as np
+import pandas as pd
+
 import coronacaster
 
+# an update file with iso dates keeps its dates, and the index updated with it matches one built from the new data
+with tempfile.TemporaryDirectory() as directory:
+    source = os.path.join(directory, 'base.csv')
+    update = os.path.join(directory, 'update.csv')
+    cache_dir = os.path.join(directory, 'cache')
+    pd.DataFrame({'dates': pd.date_range('2020-03-01', periods=20).repeat(2), 'countries': ['Finland', 'Sweden'] * 20,
+                  'cases': np.arange(40.), 'deaths': 0.}).to_csv(source, index=False)
+    with open(update, 'w') as f:
+        f.write('dates,countries,cases,deaths\n2020-03-13,Finland,100,1\n2020-03-21,Sweden,50,2\n')
+
+    index = coronacaster.CountrySeriesIndex(coronacaster.get_data_from_eu(source, cache_dir=cache_dir))
+    updated, changed = coronacaster.update_data(update, source, cache_dir, index=index)
+    assert changed == ['Finland', 'Sweden'], changed
+    assert updated.set_index(['countries', 'dates']).loc[('Finland', pd.Timestamp('2020-03-13')), 'cases'] == 100
+    assert updated.dates.max() == pd.Timestamp('2020-03-21'), updated.dates.max()
+
+    rebuilt = coronacaster.CountrySeriesIndex(updated)
+    for country in ['Finland', 'Sweden', 'World']:
+        for name, values in rebuilt.get(country).items():
+            assert np.array_equal(index.get(country)[name], values), (country, name)
+
+# the analytic fit needs no pymc3 and no network, and draws from the high orders too
+from benchmarks import synthetic_data
+
+synthetic = synthetic_data(countries=2)
+targetdate = (synthetic.dates.max() + pd.Timedelta(days=7)).date()
+for ftype in ['poly1', 'poly2', 'poly10']:
+    df = coronacaster.forecast('Country00', synthetic, ftype=ftype, method='analytic', targetdate=targetdate, plot=False)
+    assert np.isfinite(df.values).all(), (ftype, df)
+    assert df.loc['prediction_10%', 0] < df.loc['prediction', 0] < df.loc['prediction_90%', 0], (ftype, df)
+assert 'pymc3' not in sys.modules
+
+# a fit up to a cutoff gets the same priors and forecast whether or not the later data is present
+cutoff = pd.Timestamp('2020-03-01')
+known = synthetic[synthetic.dates <= cutoff]
+for country in ['Country00', 'Country01']:
+    priors = coronacaster.forecast(country, synthetic, ftype='logistic', enddate=cutoff, return_inis=True)
+    assert priors == coronacaster.forecast(country, known, ftype='logistic', enddate=cutoff, return_inis=True), priors
+
+columns = ['country', 'ftype', 'cutoff', 'prediction', 'low', 'high', 'error']
+scores = coronacaster.backtest(['Country00', 'Country01'], synthetic, ftypes=['logistic'], cutoffs=[cutoff],
+                               workers=1, cpu_cores=1, method='map')
+assert scores.error.isna().all(), scores.error
+assert scores[columns].equals(coronacaster.backtest(['Country00', 'Country01'], known, ftypes=['logistic'],
+                                                    cutoffs=[cutoff], workers=1, cpu_cores=1,
+                                                    method='map')[columns]), scores
+
 data = coronacaster.get_data_from_eu()
 coronacaster.forecast('Finland', data, startdate='2020-04-01')
 # coronacaster.forecast('Finland', data, ftype='exp')
 coronacaster.plot_country('Finland', data)
 
+# a manifest run resumes from its checkpoints, and fits again only the windows whose data changed
+from coronacaster.cli import load_manifest, run_manifest
+
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, 'manifest.json')
+    output = os.path.join(directory, 'results.csv')
+    with open(path, 'w') as f:
+        json.dump({'countries': ['Finland', 'Sweden'],
+                   'windows': [{'startdate': '2020-04-01', 'enddate': '2020-04-30'}],
+                   'params': {'method': 'map'},
+                   'cpu_cores': 1}, f)
+    manifest = load_manifest(path)
+
+    messages = []
+    first = run_manifest(manifest, output, data=data, log=messages.append)
+    again = run_manifest(manifest, output, data=data, log=messages.append)
+    assert messages[-1] == '2 fits, 2 done earlier, 0 to run', messages
+    assert first.equals(again) and first.error.isna().all(), again
+
+    corrected = data.copy()
+    corrected.loc[(corrected.countries == 'Finland') & (corrected.dates == '2020-04-15'), 'cases'] += 100
+    run_manifest(manifest, output, data=corrected, log=messages.append)
+    assert '2 fits, 1 done earlier, 1 to run' in messages, messages
+